@@ -25,7 +25,8 @@
 Simple example that connects to the first Crazyflie found, logs the Stabilizer
 and prints it to the console. After 10s the application disconnects and exits.
 
-This example utilizes the SyncCrazyflie and SyncLogger classes.
+This example utilizes the SyncCrazyflie class and a SyncLogger with a bounded
+queue.
 """
 import logging
 import time
@@ -34,9 +35,11 @@ import cflib.crtp
 from cflib.crazyflie import Crazyflie
 from cflib.crazyflie.log import LogConfig
 from cflib.crazyflie.syncCrazyflie import SyncCrazyflie
-from cflib.crazyflie.syncLogger import SyncLogger
 from cflib.utils import uri_helper
 
+from bounded_logger import BoundedSyncLogger
+from log_sink import log_sink_for
+
 
 uri = uri_helper.uri_from_env(default='radio://0/80/2M/E7E7E7E7E7')
 
@@ -55,10 +58,12 @@ if __name__ == '__main__':
 
     cf = Crazyflie(rw_cache='./cache')
     with SyncCrazyflie(uri, cf=cf) as scf:
+        log_sink = log_sink_for(lg_stab, print_every=10)
         # Note: it is possible to add more than one log config using an
         # array.
-        # with SyncLogger(scf, [lg_stab, other_conf]) as logger:
-        with SyncLogger(scf, lg_stab) as logger:
+        # with BoundedSyncLogger(scf, [lg_stab, other_conf]) as logger:
+        # At most a second of samples is queued, older ones are dropped
+        with BoundedSyncLogger(scf, lg_stab, maxsize=100) as logger:
             endTime = time.time() + 10
 
             for log_entry in logger:
@@ -66,7 +71,9 @@ if __name__ == '__main__':
                 data = log_entry[1]
                 logconf_name = log_entry[2]
 
-                print('[%d][%s]: %s' % (timestamp, logconf_name, data))
+                log_sink.append(timestamp, data)
 
                 if time.time() > endTime:
                     break
+        print(logger.report())
+        log_sink.close()
@@ -31,9 +31,11 @@ from threading import Timer
 
 import cflib.crtp  # noqa
 from cflib.crazyflie import Crazyflie
-from cflib.crazyflie.log import LogConfig
 from cflib.utils import uri_helper
 
+from log_batch import BatchLogConfig
+from log_sink import log_sink_for
+
 uri = uri_helper.uri_from_env(default='radio://0/80/2M/E7E7E7E7E7')
 
 # Only output errors from the logging framework
@@ -65,14 +67,16 @@ class LoggingExample:
 
         # Variable used to keep main loop occupied until disconnect
         self.is_connected = True
+        self._log_sink = None
 
     def _connected(self, link_uri):
         """ This callback is called form the Crazyflie API when a Crazyflie
         has been connected and the TOCs have been downloaded."""
         print('Connected to %s' % link_uri)
 
-        # The definition of the logconfig can be made before connecting
-        self._lg_stab = LogConfig(name='Stabilizer', period_in_ms=100)
+        # The definition of the logconfig can be made before connecting.
+        # Samples are decoded straight into arrays and collected by drain_logs.
+        self._lg_stab = BatchLogConfig(name='Stabilizer', period_in_ms=100)
         
         #self._lg_stab.add_variable('stateEstimate.x', 'float')
         #self._lg_stab.add_variable('stateEstimate.y', 'float')
@@ -88,13 +92,13 @@ class LoggingExample:
         # The fetch-as argument can be set to FP16 to save space in the log packet
         self._lg_stab.add_variable('pm.vbat', 'FP16')
 
+        self._log_sink = log_sink_for(self._lg_stab)
+
         # Adding the configuration cannot be done until a Crazyflie is
         # connected, since we need to check that the variables we
         # would like to log are in the TOC.
         try:
             self._cf.log.add_config(self._lg_stab)
-            # This callback will receive the data
-            self._lg_stab.data_received_cb.add_callback(self._stab_log_data)
             # This callback will be called on errors
             self._lg_stab.error_cb.add_callback(self._stab_log_error)
             # Start the logging
@@ -113,12 +117,24 @@ class LoggingExample:
         """Callback from the log API when an error occurs"""
         print('Error when logging %s: %s' % (logconf.name, msg))
 
-    def _stab_log_data(self, timestamp, data, logconf):
-        """Callback from a the log API when data arrives"""
-        print(f'[{timestamp}][{logconf.name}]: ', end='')
-        for name, value in data.items():
-            print(f'{name}: {value:3.3f} ', end='')
-        print()
+    def drain_logs(self):
+        """Store the samples received since the last call and print the latest"""
+        if self._log_sink is None:
+            return
+        batch = self._lg_stab.drain()
+        if len(batch):
+            self._log_sink.append_batch(batch)
+            latest = batch[-1]
+            print(f'[{latest["timestamp"]}][{self._lg_stab.name}] {len(batch)} samples: ', end='')
+            for name in self._lg_stab.names:
+                print(f'{name}: {latest[name]:3.3f} ', end='')
+            print()
+
+    def close_logs(self):
+        """Store what is left and close the log files"""
+        self.drain_logs()
+        if self._log_sink is not None:
+            self._log_sink.close()
 
     def _connection_failed(self, link_uri, msg):
         """Callback when connection initial connection fails (i.e no Crazyflie
@@ -147,4 +163,6 @@ if __name__ == '__main__':
     # so this is where your application should do something. In our case we
     # are just waiting until we are disconnected.
     while le.is_connected:
-        time.sleep(2)
+        time.sleep(1)
+        le.drain_logs()
+    le.close_logs()
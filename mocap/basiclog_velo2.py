@@ -31,14 +31,42 @@ from threading import Timer
 
 import cflib.crtp  # noqa
 from cflib.crazyflie import Crazyflie
-from cflib.crazyflie.log import LogConfig
 from cflib.utils import uri_helper
 
+from log_planner import LogRequest
+from log_planner import plan_logs
+from log_sink import log_sink_for
+
 uri = uri_helper.uri_from_env(default='radio://0/80/2M/E7E7E7E7E7')
 
 # Only output errors from the logging framework
 logging.basicConfig(level=logging.ERROR)
 
+# What to log and how often (Hz). fp16=True fetches a float as FP16, which
+# halves its size in the log packet at about three significant digits.
+log_requests = [
+    LogRequest('stateEstimate.x', 100),
+    LogRequest('stateEstimate.y', 100),
+    LogRequest('stateEstimate.z', 100),
+    LogRequest('stateEstimate.vx', 100),
+    LogRequest('stateEstimate.vy', 100),
+    LogRequest('stateEstimate.vz', 100),
+    LogRequest('stateEstimate.ax', 50),
+    LogRequest('stateEstimate.ay', 50),
+    LogRequest('stateEstimate.az', 50),
+    LogRequest('stabilizer.roll', 50, fp16=True),
+    LogRequest('stabilizer.pitch', 50, fp16=True),
+    LogRequest('stabilizer.yaw', 50, fp16=True),
+    LogRequest('stateEstimate.roll', 50, fp16=True),
+    LogRequest('stateEstimate.pitch', 50, fp16=True),
+    LogRequest('stateEstimate.yaw', 50, fp16=True),
+    LogRequest('stateEstimate.qx', 50, fp16=True),
+    LogRequest('stateEstimate.qy', 50, fp16=True),
+    LogRequest('stateEstimate.qz', 50, fp16=True),
+    LogRequest('stateEstimate.qw', 50, fp16=True),
+    LogRequest('pm.vbat', 1, fp16=True),
+]
+
 
 class LoggingExample:
     """
@@ -64,53 +92,27 @@ class LoggingExample:
 
         # Variable used to keep main loop occupied until disconnect
         self.is_connected = True
+        self._log_sink = None
 
     def _connected(self, link_uri):
         """ This callback is called form the Crazyflie API when a Crazyflie
         has been connected and the TOCs have been downloaded."""
         print('Connected to %s' % link_uri)
 
-        # The definition of the logconfig can be made before connecting
-        self._lg_stab = LogConfig(name='Stabilizer', period_in_ms=100)
-        self._lg_stab.add_variable('stateEstimate.x', 'float')
-        self._lg_stab.add_variable('stateEstimate.y', 'float')
-        self._lg_stab.add_variable('stateEstimate.z', 'float')
-
-        self._lg_stab.add_variable('stabilizer.roll', 'float')
-        self._lg_stab.add_variable('stabilizer.pitch', 'float')
-        self._lg_stab.add_variable('stabilizer.yaw', 'float')
-
-        self._lg_stab.add_variable('stateEstimate.vx', 'float')
-        self._lg_stab.add_variable('stateEstimate.vy', 'float')
-        self._lg_stab.add_variable('stateEstimate.vz', 'float')
-
-        self._lg_stab.add_variable('stateEstimate.ax', 'float')
-        self._lg_stab.add_variable('stateEstimate.ay', 'float')
-        self._lg_stab.add_variable('stateEstimate.az', 'float')                    
-
-        self._lg_stab.add_variable('stateEstimate.roll', 'float')
-        self._lg_stab.add_variable('stateEstimate.pitch', 'float')
-        self._lg_stab.add_variable('stateEstimate.yaw', 'float')
-
-        self._lg_stab.add_variable('stateEstimate.qx', 'float')
-        self._lg_stab.add_variable('stateEstimate.qy', 'float')
-        self._lg_stab.add_variable('stateEstimate.qz', 'float')
-        self._lg_stab.add_variable('stateEstimate.qw', 'float')
-
-        # The fetch-as argument can be set to FP16 to save space in the log packet
-        self._lg_stab.add_variable('pm.vbat', 'FP16')
-
-        # Adding the configuration cannot be done until a Crazyflie is
-        # connected, since we need to check that the variables we
-        # would like to log are in the TOC.
+        # The wanted variables do not fit in one log packet, so they are
+        # split over several log configs by rate and packet size and merged
+        # back into one stream. This needs the TOC, so it is done here.
         try:
-            self._cf.log.add_config(self._lg_stab)
+            self._log_plan = plan_logs(self._cf.log.toc, log_requests, name='Stabilizer')
+            print(self._log_plan.report())
+            self._log_sink = log_sink_for(self._log_plan, print_every=10)
+            self._log_plan.add_to(self._cf)
             # This callback will receive the data
-            self._lg_stab.data_received_cb.add_callback(self._stab_log_data)
+            self._log_plan.data_received_cb.add_callback(self._stab_log_data)
             # This callback will be called on errors
-            self._lg_stab.error_cb.add_callback(self._stab_log_error)
+            self._log_plan.error_cb.add_callback(self._stab_log_error)
             # Start the logging
-            self._lg_stab.start()
+            self._log_plan.start()
         except KeyError as e:
             print('Could not start log configuration,'
                   '{} not found in TOC'.format(str(e)))
@@ -127,10 +129,7 @@ class LoggingExample:
 
     def _stab_log_data(self, timestamp, data, logconf):
         """Callback from a the log API when data arrives"""
-        print(f'[{timestamp}][{logconf.name}]: ', end='')
-        for name, value in data.items():
-            print(f'{name}: {value:3.3f} ', end='')
-        print()
+        self._log_sink.append(timestamp, data)
 
     def _connection_failed(self, link_uri, msg):
         """Callback when connection initial connection fails (i.e no Crazyflie
@@ -146,6 +145,8 @@ class LoggingExample:
     def _disconnected(self, link_uri):
         """Callback when the Crazyflie is disconnected (called in all cases)"""
         print('Disconnected from %s' % link_uri)
+        if self._log_sink is not None:
+            self._log_sink.close()
         self.is_connected = False
 
 
@@ -0,0 +1,150 @@
+"""
+A SyncLogger with a bounded queue.
+
+cflib's SyncLogger queues every sample until the loop reading it gets to
+it. With a slow consumer, such as a loop that prints every 10 ms sample or
+does setup between reads, the queue grows without limit and the samples it
+yields are seconds old. BoundedSyncLogger is used the same way, but holds
+at most maxsize samples and, when full, does one of:
+
+    DROP_OLDEST   discard the oldest queued sample (the default: stay current)
+    DROP_NEWEST   discard the sample that just arrived (keep a gapless prefix)
+    BLOCK         make the log callback wait for room, which holds up the
+                  link's receive thread and so everything else from the drone
+
+    with BoundedSyncLogger(scf, lg_stab, maxsize=50) as logger:
+        for timestamp, data, logconf_name in logger:
+            ...
+    print(logger.report())
+
+It counts the dropped samples and the queue age of each yielded sample, the
+time it waited between arriving and being read. arrived is the host
+monotonic time the last yielded sample was received at.
+"""
+import collections
+import time
+from threading import Condition
+
+DROP_OLDEST = 'drop-oldest'
+DROP_NEWEST = 'drop-newest'
+BLOCK = 'block'
+
+_DISCONNECTED = object()
+
+
+class BoundedSyncLogger:
+    def __init__(self, crazyflie, log_config, maxsize=100, policy=DROP_OLDEST):
+        if policy not in (DROP_OLDEST, DROP_NEWEST, BLOCK):
+            raise ValueError('Unknown queue policy {!r}'.format(policy))
+        # A SyncCrazyflie or a Crazyflie, like SyncLogger
+        self._cf = getattr(crazyflie, 'cf', crazyflie)
+        self._configs = list(log_config) if isinstance(log_config, (list, tuple)) else [log_config]
+        self.maxsize = maxsize
+        self.policy = policy
+
+        self._queue = collections.deque()
+        self._condition = Condition()
+        self._connected = False
+
+        self.received = 0
+        self.yielded = 0
+        self.dropped = 0
+        self.max_depth = 0
+        self.max_age = 0.0
+        self._total_age = 0.0
+        self.arrived = None
+
+    def connect(self):
+        if self._connected:
+            raise RuntimeError('Already connected')
+        self._cf.disconnected.add_callback(self._disconnected)
+        for config in self._configs:
+            self._cf.log.add_config(config)
+            config.data_received_cb.add_callback(self._log_callback)
+            config.start()
+        self._connected = True
+
+    def disconnect(self):
+        if self._connected:
+            for config in self._configs:
+                config.stop()
+                config.delete()
+            self._remove_callbacks()
+            self._connected = False
+        with self._condition:
+            self._queue.clear()
+            self._condition.notify_all()
+
+    def is_connected(self):
+        return self._connected
+
+    def _remove_callbacks(self):
+        self._cf.disconnected.remove_callback(self._disconnected)
+        for config in self._configs:
+            config.data_received_cb.remove_callback(self._log_callback)
+
+    def _log_callback(self, timestamp, data, logconf):
+        with self._condition:
+            self.received += 1
+            if len(self._queue) >= self.maxsize:
+                if self.policy == DROP_NEWEST:
+                    self.dropped += 1
+                    return
+                if self.policy == DROP_OLDEST:
+                    self._queue.popleft()
+                    self.dropped += 1
+                else:
+                    self._condition.wait_for(lambda: len(self._queue) < self.maxsize or not self._connected)
+                    if not self._connected:
+                        return
+            self._queue.append((time.monotonic(), (timestamp, data, logconf.name)))
+            self.max_depth = max(self.max_depth, len(self._queue))
+            self._condition.notify_all()
+
+    def _disconnected(self, link_uri):
+        self._remove_callbacks()
+        self._connected = False
+        with self._condition:
+            self._queue.append((time.monotonic(), _DISCONNECTED))
+            self._condition.notify_all()
+
+    def age(self):
+        """Seconds the oldest queued sample has been waiting, 0 if the queue is empty."""
+        with self._condition:
+            if not self._queue:
+                return 0.0
+            return time.monotonic() - self._queue[0][0]
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        with self._condition:
+            self._condition.wait_for(lambda: self._queue or not self._connected)
+            if not self._queue:
+                raise StopIteration
+            arrived, entry = self._queue.popleft()
+            self._condition.notify_all()
+        if entry is _DISCONNECTED:
+            raise StopIteration
+
+        self.arrived = arrived
+        age = time.monotonic() - arrived
+        self.yielded += 1
+        self._total_age += age
+        self.max_age = max(self.max_age, age)
+        return entry
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.disconnect()
+
+    def report(self):
+        mean_age = self._total_age / self.yielded if self.yielded else 0.0
+        return 'Log queue ({}, max {}): {} received, {} read, {} dropped, depth up to {}, ' \
+               'age mean {:.1f} ms, max {:.1f} ms'.format(
+                   self.policy, self.maxsize, self.received, self.yielded, self.dropped, self.max_depth,
+                   mean_age * 1000.0, self.max_age * 1000.0)
@@ -0,0 +1,202 @@
+"""
+Kalman estimator convergence detection.
+
+The scripts used to keep three Python lists of variance samples, pop(0) from
+the front and recompute min/max on every log packet, with the variances
+logged at 2 Hz. SlidingRange keeps the window min/max with monotonic deques
+instead, so each sample costs O(1) amortized whatever the window size, which
+makes it cheap to log the variances at a much higher rate.
+"""
+import time
+from collections import deque
+
+from cflib.crazyflie.log import LogConfig
+from cflib.crazyflie.syncLogger import SyncLogger
+
+VARIANCE_VARIABLES = ('kalman.varPX', 'kalman.varPY', 'kalman.varPZ')
+ESTIMATE_VARIABLES = ('stateEstimate.x', 'stateEstimate.y', 'stateEstimate.z')
+
+
+class SlidingRange:
+    """
+    Minimum and maximum of the last `window` values pushed.
+    """
+
+    def __init__(self, window):
+        if window < 1:
+            raise ValueError('window must be at least 1')
+        self.window = window
+        self._count = 0
+        # (index, value) pairs, values increasing in _min and decreasing in _max
+        self._min = deque()
+        self._max = deque()
+
+    def push(self, value):
+        index = self._count
+        self._count += 1
+
+        while self._min and self._min[-1][1] >= value:
+            self._min.pop()
+        self._min.append((index, value))
+        while self._max and self._max[-1][1] <= value:
+            self._max.pop()
+        self._max.append((index, value))
+
+        oldest = index - self.window
+        if self._min[0][0] <= oldest:
+            self._min.popleft()
+        if self._max[0][0] <= oldest:
+            self._max.popleft()
+
+    def full(self):
+        return self._count >= self.window
+
+    def min(self):
+        return self._min[0][1]
+
+    def max(self):
+        return self._max[0][1]
+
+    def spread(self):
+        return self._max[0][1] - self._min[0][1]
+
+
+class ConvergenceDetector:
+    """
+    Declares convergence once every variable has a full window of samples
+    and its max - min over that window is below the threshold.
+    """
+
+    def __init__(self, names=VARIANCE_VARIABLES, window=10, threshold=0.001):
+        self.threshold = threshold
+        self.samples = 0
+        self._ranges = {name: SlidingRange(window) for name in names}
+
+    def update(self, data):
+        """Feed one log sample (a name -> value dict), returns converged()."""
+        for name, sliding_range in self._ranges.items():
+            sliding_range.push(data[name])
+        self.samples += 1
+        return self.converged()
+
+    def converged(self):
+        for sliding_range in self._ranges.values():
+            if not sliding_range.full() or sliding_range.spread() >= self.threshold:
+                return False
+        return True
+
+    def spreads(self):
+        return {name: sliding_range.spread() for name, sliding_range in self._ranges.items()
+                if sliding_range.full()}
+
+
+def wait_for_convergence(scf, period_in_ms=100, window=10, threshold=0.001, timeout=None):
+    """
+    Block until the Kalman position variances have settled and return the
+    time to ready in seconds. The variance log config only lives for the
+    duration of the wait, it is removed from the Crazyflie on return.
+
+    Returns None if timeout (seconds) expires first.
+    """
+    print('Waiting for estimator to find position...')
+
+    log_config = LogConfig(name='Kalman Variance', period_in_ms=period_in_ms)
+    for name in VARIANCE_VARIABLES:
+        log_config.add_variable(name, 'float')
+
+    detector = ConvergenceDetector(VARIANCE_VARIABLES, window, threshold)
+    start = time.monotonic()
+
+    with SyncLogger(scf, log_config) as logger:
+        for log_entry in logger:
+            if detector.update(log_entry[1]):
+                time_to_ready = time.monotonic() - start
+                print('Estimator ready after {:.2f} s ({} samples at {} ms)'.format(
+                    time_to_ready, detector.samples, period_in_ms))
+                return time_to_ready
+
+            if timeout is not None and time.monotonic() - start > timeout:
+                print('Estimator did not converge within {:.1f} s, spreads: {}'.format(
+                    timeout, detector.spreads()))
+                return None
+
+
+def estimator_is_ready(scf, mocap_pose, samples=5, period_in_ms=20,
+                       variance_threshold=0.001, position_tolerance=0.05):
+    """
+    Take a short burst of variance and position estimate samples and check
+    that the estimator is settled and agrees with mocap. Returns a
+    (ready, reason) tuple, where reason describes the deciding measurement.
+    """
+    if mocap_pose is None:
+        return False, 'no mocap pose'
+
+    log_config = LogConfig(name='Kalman Readiness', period_in_ms=period_in_ms)
+    for name in VARIANCE_VARIABLES + ESTIMATE_VARIABLES:
+        log_config.add_variable(name, 'float')
+
+    detector = ConvergenceDetector(VARIANCE_VARIABLES, samples, variance_threshold)
+    estimate_sum = [0.0, 0.0, 0.0]
+    worst_variance = 0.0
+
+    with SyncLogger(scf, log_config) as logger:
+        for log_entry in logger:
+            data = log_entry[1]
+            detector.update(data)
+            for i, name in enumerate(ESTIMATE_VARIABLES):
+                estimate_sum[i] += data[name]
+            worst_variance = max(worst_variance, *(data[name] for name in VARIANCE_VARIABLES))
+            if detector.samples >= samples:
+                break
+
+    if worst_variance >= variance_threshold:
+        return False, 'variance {:.2e} above {:.0e}'.format(worst_variance, variance_threshold)
+    if not detector.converged():
+        return False, 'variance still changing'
+
+    error = sum((estimate_sum[i] / detector.samples - mocap_pose[i]) ** 2 for i in range(3)) ** 0.5
+    if error > position_tolerance:
+        return False, 'estimate {:.3f} m from mocap'.format(error)
+
+    return True, 'variance {:.2e}, estimate {:.3f} m from mocap'.format(worst_variance, error)
+
+
+class ResetFastPath:
+    """
+    Wraps a reset_estimator(cf) function so that the reset, and the wait for
+    reconvergence that comes with it, is skipped when the estimator is
+    already healthy. The duration of the last full reset is used to report
+    the time saved by each skip.
+    """
+
+    def __init__(self, reset, **readiness_kwargs):
+        self.reset = reset
+        self.readiness_kwargs = readiness_kwargs
+        self.last_reset_duration = None
+        self.resets = 0
+        self.skips = 0
+        self.time_saved = 0.0
+
+    def __call__(self, cf, mocap_pose):
+        start = time.monotonic()
+        ready, reason = estimator_is_ready(cf, mocap_pose, **self.readiness_kwargs)
+        check_duration = time.monotonic() - start
+
+        if ready:
+            self.skips += 1
+            if self.last_reset_duration is None:
+                print('Estimator reset skipped: {} (check took {:.2f} s)'.format(
+                    reason, check_duration))
+            else:
+                saved = self.last_reset_duration - check_duration
+                self.time_saved += saved
+                print('Estimator reset skipped: {}, saved {:.2f} s ({:.1f} s in total)'.format(
+                    reason, saved, self.time_saved))
+            return False
+
+        print('Estimator reset needed: {}'.format(reason))
+        start = time.monotonic()
+        self.reset(cf)
+        self.last_reset_duration = time.monotonic() - start
+        self.resets += 1
+        return True
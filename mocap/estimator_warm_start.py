@@ -0,0 +1,156 @@
+"""
+Kalman estimator warm start from live mocap.
+
+A plain reset starts the filter from its default initial state (the origin,
+yaw 0, large variances) and the extpose stream has to pull it all the way to
+where the Crazyflie actually is. Writing the current mocap pose into the
+kalman.initial* parameters before the reset lets it start from the right
+place instead.
+
+Run as a script to benchmark convergence time with and without warm start,
+by default against the simulated (SITL) link with a static synthetic pose:
+
+    python estimator_warm_start.py --trials 10
+    python estimator_warm_start.py --uri radio://0/80/2M/E7E7E7E7E7 --pose 0.5 -0.2 0.0 90
+"""
+import argparse
+import math
+import time
+from collections import namedtuple
+
+import cflib.crtp
+from cflib.crazyflie import Crazyflie
+from cflib.crazyflie.syncCrazyflie import SyncCrazyflie
+from cflib.utils import uri_helper
+
+from estimator_convergence import wait_for_convergence
+from param_batch import apply_params
+from pose_scheduler import PoseScheduler
+
+Quaternion = namedtuple('Quaternion', ['x', 'y', 'z', 'w'])
+
+
+def yaw_from_orientation(orientation):
+    """
+    Yaw in radians from the orientation part of a mocap pose, which is a
+    quaternion object (motioncapture) or a 3x3 rotation matrix (QTM, Vicon UDP).
+    """
+    if hasattr(orientation, 'w'):
+        q = orientation
+        return math.atan2(2.0 * (q.w * q.z + q.x * q.y), 1.0 - 2.0 * (q.y * q.y + q.z * q.z))
+    return math.atan2(orientation[1][0], orientation[0][0])
+
+
+def quaternion_from_yaw(yaw):
+    return Quaternion(0.0, 0.0, math.sin(yaw / 2.0), math.cos(yaw / 2.0))
+
+
+def reset_from_initial_state(cf, x, y, z, yaw):
+    """
+    Write the initial state and trigger the reset as one acknowledged batch;
+    the writes are confirmed in order, so the reset sees the new state.
+    """
+    apply_params(cf, [
+        ('kalman.initialX', x),
+        ('kalman.initialY', y),
+        ('kalman.initialZ', z),
+        ('kalman.initialYaw', yaw),
+        ('kalman.resetEstimation', '1'),
+        ('kalman.resetEstimation', '0'),
+    ], label='Estimator reset')
+
+
+def wait_for_pose(pose_source, timeout=5.0):
+    end_time = time.monotonic() + timeout
+    while pose_source.latest() is None:
+        if time.monotonic() > end_time:
+            return None
+        time.sleep(0.01)
+    return pose_source.latest()
+
+
+def warm_start_estimator(cf, pose_source, prestream=0.3, **convergence_kwargs):
+    """
+    Reset the estimator with its initial state taken from the latest mocap
+    pose. pose_source is anything with a latest() method, typically the
+    PoseScheduler that is already streaming extpose to the Crazyflie; the
+    stream runs for `prestream` seconds before the reset so the filter gets
+    measurements as soon as it restarts.
+
+    Falls back to a cold reset if no pose arrives. Returns the time to
+    ready as reported by wait_for_convergence.
+    """
+    pose = wait_for_pose(pose_source)
+    if pose is None:
+        print('No mocap pose, resetting estimator from its default state')
+        reset_from_initial_state(cf, 0.0, 0.0, 0.0, 0.0)
+    else:
+        time.sleep(prestream)
+        pose = pose_source.latest()
+        yaw = yaw_from_orientation(pose[3])
+        print('Warm starting estimator at ({:.3f}, {:.3f}, {:.3f}), yaw {:.1f} deg'.format(
+            pose[0], pose[1], pose[2], math.degrees(yaw)))
+        reset_from_initial_state(cf, pose[0], pose[1], pose[2], yaw)
+
+    return wait_for_convergence(cf, **convergence_kwargs)
+
+
+def cold_start_estimator(cf, **convergence_kwargs):
+    """Reset from the firmware default initial state, for comparison."""
+    reset_from_initial_state(cf, 0.0, 0.0, 0.0, 0.0)
+    return wait_for_convergence(cf, **convergence_kwargs)
+
+
+def _summary(label, times):
+    converged = [t for t in times if t is not None]
+    if not converged:
+        return '{}: no trial converged'.format(label)
+    return '{}: mean {:.2f} s, min {:.2f} s, max {:.2f} s ({} of {} converged)'.format(
+        label, sum(converged) / len(converged), min(converged), max(converged),
+        len(converged), len(times))
+
+
+def benchmark(cf, pose_source, trials=5, timeout=20.0):
+    """
+    Alternate cold and warm resets and report the convergence times.
+    Alternating keeps slow drifts (battery, temperature) from favouring
+    either variant.
+    """
+    cold_times = []
+    warm_times = []
+    for trial in range(trials):
+        print('Trial {} of {}'.format(trial + 1, trials))
+        cold_times.append(cold_start_estimator(cf, timeout=timeout))
+        warm_times.append(warm_start_estimator(cf, pose_source, timeout=timeout))
+
+    print(_summary('Cold start', cold_times))
+    print(_summary('Warm start', warm_times))
+    return cold_times, warm_times
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--uri', default=uri_helper.uri_from_env(default='udp://0.0.0.0:19850'))
+    parser.add_argument('--trials', type=int, default=5)
+    parser.add_argument('--pose', type=float, nargs=4, default=[1.0, -0.5, 0.0, 45.0],
+                        metavar=('X', 'Y', 'Z', 'YAW_DEG'),
+                        help='static pose streamed as mocap, yaw in degrees')
+    args = parser.parse_args()
+
+    cflib.crtp.init_drivers()
+
+    with SyncCrazyflie(args.uri, cf=Crazyflie(rw_cache='./cache')) as scf:
+        cf = scf.cf
+        apply_params(cf, [('stabilizer.estimator', '2')])
+
+        x, y, z, yaw_deg = args.pose
+        pose_scheduler = PoseScheduler(
+            lambda pose: cf.extpos.send_extpose(pose[0], pose[1], pose[2],
+                                                pose[3].x, pose[3].y, pose[3].z, pose[3].w),
+            rate_hz=100)
+        pose_scheduler.max_age = float('inf')
+        pose_scheduler.on_pose([x, y, z, quaternion_from_yaw(math.radians(yaw_deg))])
+
+        benchmark(cf, pose_scheduler, args.trials)
+
+        pose_scheduler.close()
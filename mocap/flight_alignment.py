@@ -0,0 +1,239 @@
+"""
+Time alignment of mocap frames and onboard logs.
+
+Onboard log samples carry the drone's millisecond timestamp, mocap frames
+arrive on the host's monotonic clock, and nothing related the two. A
+FlightAligner records both, estimates the drone-to-host clock mapping from
+the host receive times of the log samples, and resamples everything onto
+one host timeline at a fixed rate, giving one table per flight:
+
+    aligner = FlightAligner(rate_hz=100, forward_pose=pose_scheduler.on_pose)
+    mocap_wrapper.on_pose = aligner.on_pose
+    ...
+    aligner.add_log_sample(timestamp, data, host_time)   # or add_log(batch)
+    rows = aligner.update()     # in flight: the rows that became complete
+    table = aligner.merged()    # after the flight: the whole flight
+    table['time'], table['mocap.x'], table['stateEstimate.x']
+
+The clock is modelled as host = offset + drift * drone. Receive times are
+the send times plus a delay that is never negative, so drift is fitted to
+all samples by least squares and the line is then lowered onto the samples
+with the least delay (the offset includes the link's smallest delay). Both
+streams are resampled with np.interp column by column; quaternions are
+sign-aligned before and normalized after. Timeline points further than
+max_gap from any sample of a stream are NaN for it.
+
+align_flight does the same in batch, for instance on files written by the
+log sink: align_flight(load_log(d, 'Stabilizer'), load_log(d, 'mocap')).
+"""
+import time
+from threading import Lock
+
+import numpy as np
+
+MOCAP_FIELDS = ['mocap.x', 'mocap.y', 'mocap.z', 'mocap.qx', 'mocap.qy', 'mocap.qz', 'mocap.qw']
+
+# Columns of log sink and BatchLogConfig rows that are not variables
+TIME_COLUMNS = ('timestamp', 'host_time')
+
+
+def mocap_row(pose):
+    """The MOCAP_FIELDS values of an [x, y, z, orientation] pose; NaN orientation unless it is a quaternion."""
+    orientation = pose[3]
+    if all(hasattr(orientation, axis) for axis in 'xyzw'):
+        quaternion = [orientation.x, orientation.y, orientation.z, orientation.w]
+    else:
+        quaternion = [np.nan] * 4
+    return [float(pose[0]), float(pose[1]), float(pose[2])] + quaternion
+
+
+class ClockEstimate:
+    """host seconds = offset + drift * drone seconds"""
+
+    def __init__(self, offset=0.0, drift=1.0):
+        self.offset = offset
+        self.drift = drift
+
+    def to_host(self, drone):
+        return self.offset + self.drift * drone
+
+    def to_drone(self, host):
+        return (host - self.offset) / self.drift
+
+    def __str__(self):
+        return 'host = drone {:+.3f} s, drift {:+.1f} ppm'.format(self.offset, (self.drift - 1.0) * 1e6)
+
+
+def fit_clock(drone, host):
+    """ClockEstimate from the drone times and host receive times of log samples, in seconds."""
+    drone = np.asarray(drone, dtype=np.float64)
+    host = np.asarray(host, dtype=np.float64)
+    if len(drone) < 2 or drone[-1] - drone[0] < 1.0:
+        # Too short to see drift
+        return ClockEstimate(float(np.min(host - drone)), 1.0)
+    origin = drone[0]
+    drift, offset = np.polyfit(drone - origin, host, 1)
+    # Lower the line onto the least delayed samples
+    offset += np.min(host - (offset + drift * (drone - origin)))
+    return ClockEstimate(float(offset - drift * origin), float(drift))
+
+
+def _continuous_quaternions(values):
+    """Flip quaternion signs so consecutive ones are in the same hemisphere."""
+    dots = np.einsum('ij,ij->i', values[1:], values[:-1])
+    signs = np.concatenate([[1.0], np.cumprod(np.where(dots < 0.0, -1.0, 1.0))])
+    return values * signs[:, None]
+
+
+def resample(times, sample_times, values, max_gap):
+    """Interpolate the columns of values (N, K) at times; NaN more than max_gap from a sample."""
+    out = np.full((len(times), values.shape[1]), np.nan)
+    if len(sample_times) == 0:
+        return out
+    for column in range(values.shape[1]):
+        out[:, column] = np.interp(times, sample_times, values[:, column], left=np.nan, right=np.nan)
+    if len(sample_times) == 1:
+        nearest = np.abs(times - sample_times[0])
+    else:
+        index = np.clip(np.searchsorted(sample_times, times), 1, len(sample_times) - 1)
+        nearest = np.minimum(np.abs(times - sample_times[index - 1]), np.abs(sample_times[index] - times))
+    out[nearest > max_gap] = np.nan
+    return out
+
+
+def _table(times, clock, mocap_values, log_names, log_values):
+    dtype = [('time', '<f8'), ('drone_time', '<f8')] + [(name, '<f8') for name in MOCAP_FIELDS + log_names]
+    table = np.empty(len(times), dtype)
+    table['time'] = times
+    table['drone_time'] = clock.to_drone(times)
+    for column, name in enumerate(MOCAP_FIELDS):
+        table[name] = mocap_values[:, column]
+    for column, name in enumerate(log_names):
+        table[name] = log_values[:, column]
+    return table
+
+
+class FlightAligner:
+    def __init__(self, rate_hz=100, max_gap=0.1, forward_pose=None):
+        self.period = 1.0 / rate_hz
+        self.max_gap = max_gap
+        # Called with every pose after it is recorded, such as PoseScheduler.on_pose
+        self.forward_pose = forward_pose
+        # Mocap frames and log samples arrive on other threads than update() runs on
+        self._lock = Lock()
+        self.reset()
+
+    def reset(self):
+        """Forget everything recorded, to start the next flight."""
+        self.clock = ClockEstimate()
+        self.log_names = None
+        self._mocap = []
+        self._log = []
+        self._pending_mocap = []
+        self._pending_log = []
+        self._next_time = None
+
+    def on_pose(self, pose):
+        """Mocap wrapper callback: record the frame at its host arrival time."""
+        row = [time.monotonic()] + mocap_row(pose)
+        with self._lock:
+            self._pending_mocap.append(row)
+        if self.forward_pose is not None:
+            self.forward_pose(pose)
+
+    def add_mocap(self, host_times, rows):
+        """Mocap frames recorded elsewhere: host times and (N, 7) MOCAP_FIELDS rows."""
+        self._mocap.append(np.column_stack([host_times, rows]).astype(np.float64))
+
+    def add_log_sample(self, timestamp, data, host_time=None):
+        """One log sample, as a log callback or SyncLogger yields it, with its host receive time."""
+        if self.log_names is None:
+            self.log_names = list(data)
+        row = [timestamp / 1000.0, time.monotonic() if host_time is None else host_time]
+        row += [data[name] for name in self.log_names]
+        with self._lock:
+            self._pending_log.append(row)
+
+    def add_log(self, batch):
+        """Log rows as a structured array with timestamp (ms), host_time and a column per variable."""
+        if self.log_names is None:
+            self.log_names = [name for name in batch.dtype.names if name not in TIME_COLUMNS]
+        self._log.append(np.column_stack([batch['timestamp'] / 1000.0, batch['host_time']] +
+                                         [batch[name] for name in self.log_names]).astype(np.float64))
+
+    def _collect(self):
+        with self._lock:
+            pending_mocap, self._pending_mocap = self._pending_mocap, []
+            pending_log, self._pending_log = self._pending_log, []
+        if pending_mocap:
+            self._mocap.append(np.array(pending_mocap, dtype=np.float64))
+        if pending_log:
+            self._log.append(np.array(pending_log, dtype=np.float64))
+        if len(self._mocap) > 1:
+            self._mocap = [np.concatenate(self._mocap)]
+        if len(self._log) > 1:
+            self._log = [np.concatenate(self._log)]
+        return (self._mocap[0] if self._mocap else np.empty((0, 1 + len(MOCAP_FIELDS))),
+                self._log[0] if self._log else None)
+
+    def _resampled(self, times, mocap, log):
+        mocap_values = mocap[:, 1:]
+        quaternions = slice(3, 7)
+        if len(mocap_values):
+            mocap_values = mocap_values.copy()
+            mocap_values[:, quaternions] = _continuous_quaternions(mocap_values[:, quaternions])
+        mocap_out = resample(times, mocap[:, 0], mocap_values, self.max_gap)
+        norms = np.linalg.norm(mocap_out[:, quaternions], axis=1, keepdims=True)
+        mocap_out[:, quaternions] /= norms
+
+        log_out = resample(times, self.clock.to_host(log[:, 0]), log[:, 2:], self.max_gap)
+        return _table(times, self.clock, mocap_out, self.log_names, log_out)
+
+    def update(self):
+        """
+        Rows of the timeline that both streams now cover, from where the
+        last update stopped. They use the clock estimate of the moment, so
+        merged() can differ slightly once more samples refine it.
+        """
+        mocap, log = self._collect()
+        if log is None or len(mocap) == 0:
+            return None
+        self.clock = fit_clock(log[:, 0], log[:, 1])
+
+        log_host = self.clock.to_host(log[:, 0])
+        if self._next_time is None:
+            self._next_time = max(mocap[0, 0], log_host[0])
+        horizon = min(mocap[-1, 0], log_host[-1])
+        count = int(np.floor((horizon - self._next_time) / self.period)) + 1
+        if count <= 0:
+            return None
+        times = self._next_time + self.period * np.arange(count)
+        self._next_time = times[-1] + self.period
+        return self._resampled(times, mocap, log)
+
+    def merged(self):
+        """The whole flight on one timeline, with the final clock estimate."""
+        mocap, log = self._collect()
+        if log is None or len(log) < 2 or len(mocap) < 2:
+            raise ValueError('At least two mocap frames and two log samples are needed to align a flight')
+        self.clock = fit_clock(log[:, 0], log[:, 1])
+        log_host = self.clock.to_host(log[:, 0])
+        start = max(mocap[0, 0], log_host[0])
+        end = min(mocap[-1, 0], log_host[-1])
+        times = start + self.period * np.arange(int(np.floor((end - start) / self.period)) + 1)
+        return self._resampled(times, mocap, log)
+
+
+def align_flight(log, mocap, rate_hz=100, max_gap=0.1):
+    """
+    Batch alignment of log rows (structured, with timestamp and host_time)
+    and mocap rows (structured, with host_time and MOCAP_FIELDS), such as
+    load_log returns for the log sink's files.
+    """
+    aligner = FlightAligner(rate_hz, max_gap)
+    aligner.add_log(log)
+    aligner.add_mocap(mocap['host_time'], np.column_stack([mocap[name] for name in MOCAP_FIELDS]))
+    table = aligner.merged()
+    print('Aligned {} log and {} mocap samples into {} rows, {}'.format(
+        len(log), len(mocap), len(table), aligner.clock))
+    return table
@@ -0,0 +1,209 @@
+"""
+Event-driven flight sequencing.
+
+run_sequence used to chain high level commands with fixed sleeps sized for
+the worst case. Here each phase issues its command and then waits until the
+logged state estimate shows it is done: the takeoff height is reached, the
+trajectory has finished, or the Crazyflie has landed and settled. Every
+phase has a timeout, after which the sequence moves on as the fixed sleeps
+did, and the report compares actual phase durations with the padded ones.
+
+    sequencer = FlightSequencer(cf)
+    sequencer.run([
+        takeoff_phase(commander, 1.0, 2.0),
+        trajectory_phase(commander, trajectory_id, duration, time_scale),
+        land_phase(commander, 0.0, 2.0),
+    ])
+    commander.stop()
+"""
+import math
+import time
+from threading import Condition
+
+from cflib.crazyflie.log import LogConfig
+
+STATE_VARIABLES = ('stateEstimate.x', 'stateEstimate.y', 'stateEstimate.z',
+                   'stateEstimate.vx', 'stateEstimate.vy', 'stateEstimate.vz')
+
+
+def speed(state):
+    return math.sqrt(state['stateEstimate.vx'] ** 2 + state['stateEstimate.vy'] ** 2 +
+                     state['stateEstimate.vz'] ** 2)
+
+
+class Phase:
+    """
+    One step of a flight. start() issues the command; done(state, elapsed,
+    sequencer) tells from the latest state estimate whether the step has
+    finished, and must keep doing so for hold seconds. padded is the fixed
+    sleep the step used to take, for the report.
+    """
+
+    def __init__(self, name, start, done, timeout, padded=None, hold=0.0):
+        self.name = name
+        self.start = start
+        self.done = done
+        self.timeout = timeout
+        self.padded = padded
+        self.hold = hold
+
+
+class PhaseResult:
+    def __init__(self, name, duration, padded, timed_out):
+        self.name = name
+        self.duration = duration
+        self.padded = padded
+        self.timed_out = timed_out
+
+    def __str__(self):
+        padded = '{:6.2f} s'.format(self.padded) if self.padded is not None else '     - '
+        return '{:<12} {:6.2f} s   padded {}{}'.format(
+            self.name, self.duration, padded, '   TIMED OUT' if self.timed_out else '')
+
+
+def takeoff_phase(commander, height=1.0, duration=2.0, tolerance=0.05, max_speed=0.1, padded=3.0):
+    """Take off to an absolute height; done once within tolerance and slow."""
+    return Phase('takeoff', lambda: commander.takeoff(height, duration),
+                 lambda state, elapsed, sequencer: (abs(state['stateEstimate.z'] - height) < tolerance and
+                                                    speed(state) < max_speed),
+                 timeout=duration + 3.0, padded=padded, hold=0.1)
+
+
+def trajectory_phase(commander, trajectory_id, duration, time_scale=1.0, relative=True, max_speed=0.2,
+                     padded=None):
+    """Fly an uploaded trajectory; done once its scaled duration has passed and the Crazyflie has slowed down."""
+    flight_time = duration * time_scale
+    return Phase('trajectory', lambda: commander.start_trajectory(trajectory_id, time_scale, relative),
+                 lambda state, elapsed, sequencer: elapsed >= flight_time and speed(state) < max_speed,
+                 timeout=flight_time + 2.0, padded=flight_time if padded is None else padded)
+
+
+def go_to_phase(commander, x, y, z, yaw, duration, relative=False, tolerance=0.05, max_speed=0.1, padded=None):
+    """Go to a position; done once within tolerance of it and slow. Relative targets are taken from the phase start."""
+    target = {}
+
+    def _start():
+        target.clear()
+        commander.go_to(x, y, z, yaw, duration, relative)
+
+    def _done(state, elapsed, sequencer):
+        if not target:
+            origin = sequencer.phase_start_state if relative else None
+            for axis, value in zip('xyz', (x, y, z)):
+                name = 'stateEstimate.' + axis
+                target[name] = value + (origin[name] if origin else 0.0)
+        distance = math.sqrt(sum((state[name] - value) ** 2 for name, value in target.items()))
+        return distance < tolerance and speed(state) < max_speed
+
+    return Phase('go_to', _start, _done, timeout=duration + 3.0,
+                 padded=duration + 1.0 if padded is None else padded, hold=0.1)
+
+
+def land_phase(commander, height=0.0, duration=2.0, tolerance=0.02, max_speed=0.02, settle=0.5, padded=2.0):
+    """
+    Land; done once the land command's duration has passed and the Crazyflie
+    is back within tolerance of the height the sequence started at and still
+    for settle seconds. Stricter than the other phases, since stop() after it
+    cuts the motors.
+    """
+    return Phase('land', lambda: commander.land(height, duration),
+                 lambda state, elapsed, sequencer: (elapsed >= duration and
+                                                    state['stateEstimate.z'] < sequencer.ground_z + tolerance and
+                                                    speed(state) < max_speed),
+                 timeout=duration + 3.0, padded=padded, hold=settle)
+
+
+class FlightSequencer:
+    """
+    Runs phases back to back on the state estimate, logged at period_in_ms.
+    The log config is only active while run() is, so one sequencer can run
+    the phases before and after something else, such as chained trajectories.
+    """
+
+    def __init__(self, cf, period_in_ms=20):
+        self.cf = cf
+        self.period_in_ms = period_in_ms
+        self.state = None
+        # Height of the first state estimate this sequencer saw, taken as the ground
+        self.ground_z = None
+        self.phase_start_state = None
+        self.results = []
+        self._samples = 0
+        self._condition = Condition()
+
+    def _log_data(self, timestamp, data, logconf):
+        with self._condition:
+            self.state = data
+            self._samples += 1
+            self._condition.notify_all()
+
+    def _wait_for_sample(self, after, deadline):
+        with self._condition:
+            self._condition.wait_for(lambda: self._samples > after, max(0.0, deadline - time.monotonic()))
+            return self._samples, self.state
+
+    def _run_phase(self, phase):
+        with self._condition:
+            samples, state = self._samples, self.state
+        self.phase_start_state = state
+
+        start = time.monotonic()
+        deadline = start + phase.timeout
+        phase.start()
+
+        held_since = None
+        while True:
+            samples, state = self._wait_for_sample(samples, deadline)
+            now = time.monotonic()
+            if state is not None and phase.done(state, now - start, self):
+                if held_since is None:
+                    held_since = now
+                if now - held_since >= phase.hold:
+                    return PhaseResult(phase.name, now - start, phase.padded, False)
+            else:
+                held_since = None
+            if now >= deadline:
+                return PhaseResult(phase.name, now - start, phase.padded, True)
+
+    def run(self, phases):
+        """Run phases in order. Returns the list of PhaseResults and prints the report."""
+        with self._condition:
+            self.state = None
+            self._samples = 0
+
+        log_config = LogConfig(name='Sequencer state', period_in_ms=self.period_in_ms)
+        for name in STATE_VARIABLES:
+            log_config.add_variable(name, 'float')
+        self.cf.log.add_config(log_config)
+        log_config.data_received_cb.add_callback(self._log_data)
+        log_config.start()
+
+        self.results = []
+        try:
+            _, state = self._wait_for_sample(0, time.monotonic() + 2.0)
+            if state is None:
+                raise TimeoutError('No state estimate logged, cannot sequence the flight')
+            if self.ground_z is None:
+                self.ground_z = state['stateEstimate.z']
+
+            for phase in phases:
+                result = self._run_phase(phase)
+                self.results.append(result)
+                if result.timed_out:
+                    print('Phase {} timed out after {:.1f} s, continuing'.format(phase.name, result.duration))
+        finally:
+            log_config.stop()
+            log_config.delete()
+
+        print(self.report())
+        return self.results
+
+    def report(self):
+        lines = ['Flight phases:'] + ['  {}'.format(result) for result in self.results]
+        actual = sum(result.duration for result in self.results)
+        padded_results = [result for result in self.results if result.padded is not None]
+        padded = sum(result.padded for result in padded_results)
+        actual_of_padded = sum(result.duration for result in padded_results)
+        lines.append('  total {:.2f} s, {:.2f} s saved against the padded sequence'.format(
+            actual, padded - actual_of_padded))
+        return '\n'.join(lines)
@@ -0,0 +1,111 @@
+"""
+Persistent flight sessions.
+
+The scripts' while True loops redid the whole preflight on every iteration:
+reassign on_pose, sleep 3 s, rewrite the estimator parameters, re-upload the
+trajectory and reset the estimator. A FlightSession does the setup once per
+connection and then runs sorties, each with only the steps still needed:
+
+    session = FlightSession(cf, pose_scheduler, params=preflight_params,
+                            reset_estimator=reset_fast_path, library=library)
+    while True:
+        session.sortie(lambda trajectory_id, duration: run_sequence(cf, trajectory_id, duration),
+                       mission='figure8')
+
+Setup is redone after a disconnect. Selecting a mission goes through the
+trajectory library, so it only uploads when the trajectory is not resident,
+and reset_estimator is typically a ResetFastPath, which skips the reset when
+the estimator is healthy. The report gives the turnaround between sorties,
+from the end of one flight to the start of the next.
+"""
+import time
+
+from estimator_warm_start import wait_for_pose
+from param_batch import apply_params
+
+
+class SortieRecord:
+    def __init__(self, index, steps, turnaround, flight):
+        self.index = index
+        # (step name, seconds) of the setup steps this sortie ran
+        self.steps = steps
+        self.turnaround = turnaround
+        self.flight = flight
+
+    def __str__(self):
+        steps = ', '.join('{} {:.2f} s'.format(name, seconds) for name, seconds in self.steps)
+        return 'Sortie {}: turnaround {:.2f} s ({}), flight {:.2f} s'.format(
+            self.index, self.turnaround, steps or 'no setup', self.flight)
+
+
+class FlightSession:
+    def __init__(self, cf, pose_source=None, params=(), reset_estimator=None, library=None,
+                 pose_timeout=5.0):
+        self.cf = cf
+        self.pose_source = pose_source
+        self.params = list(params)
+        self.reset_estimator = reset_estimator
+        self.library = library
+        self.pose_timeout = pose_timeout
+
+        self.configured = False
+        self.sorties = []
+        # Turnaround of the first sortie counts from the session start
+        self._last_flight_end = time.monotonic()
+        cf.disconnected.add_callback(self._disconnected)
+
+    def _disconnected(self, link_uri):
+        self.configured = False
+
+    def _configure(self):
+        if self.pose_source is not None and wait_for_pose(self.pose_source, self.pose_timeout) is None:
+            raise TimeoutError('No mocap pose within {:.1f} s'.format(self.pose_timeout))
+        if self.params:
+            apply_params(self.cf, self.params, label='Session configuration')
+        self.configured = True
+
+    def sortie(self, fly, mission=None):
+        """
+        Run the setup steps that are still needed, then fly. With a mission
+        name the library's trajectory is selected first and fly is called
+        with (trajectory_id, duration), otherwise without arguments.
+        Returns what fly returns.
+        """
+        steps = []
+
+        def _step(name, action):
+            start = time.monotonic()
+            result = action()
+            steps.append((name, time.monotonic() - start))
+            return result
+
+        if not self.configured:
+            _step('configure', self._configure)
+        selected = ()
+        if mission is not None:
+            selected = _step('trajectory', lambda: self.library.select(mission))
+        if self.reset_estimator is not None:
+            pose = self.pose_source.latest() if self.pose_source is not None else None
+            _step('estimator', lambda: self.reset_estimator(self.cf, pose))
+
+        flight_start = time.monotonic()
+        turnaround = flight_start - self._last_flight_end
+        try:
+            return fly(*selected)
+        finally:
+            self._last_flight_end = time.monotonic()
+            record = SortieRecord(len(self.sorties) + 1, steps, turnaround,
+                                  self._last_flight_end - flight_start)
+            self.sorties.append(record)
+            print(record)
+
+    def report(self):
+        if not self.sorties:
+            return 'Session: no sorties'
+        later = [record.turnaround for record in self.sorties[1:]]
+        summary = 'Session: {} sorties, first turnaround {:.2f} s'.format(
+            len(self.sorties), self.sorties[0].turnaround)
+        if later:
+            summary += ', later turnarounds mean {:.2f} s (min {:.2f} s, max {:.2f} s)'.format(
+                sum(later) / len(later), min(later), max(later))
+        return summary
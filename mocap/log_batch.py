@@ -0,0 +1,115 @@
+"""
+Batch log decoding into NumPy arrays.
+
+A LogConfig decodes every packet variable by variable into a new dict and
+calls its callbacks with it, which at high rates costs more than the
+decoding itself. BatchLogConfig is a LogConfig that decodes each packet with
+one precompiled struct.Struct, built from the unpack strings of the TOC
+types the variables are fetched as, and appends the values as one row of a
+preallocated columnar array: the drone timestamp, the host receive time and
+one column per variable. drain() hands over everything received since the
+last call as a NumPy view:
+
+    log_config = BatchLogConfig(name='Stabilizer', period_in_ms=10)
+    log_config.add_variable('stateEstimate.x', 'float')
+    cf.log.add_config(log_config)
+    log_config.start()
+    ...
+    batch = log_config.drain()
+    batch['timestamp'], batch['stateEstimate.x']
+
+Consumers that want each sample as soon as it arrives can register on
+tuple_received_cb, called with (timestamp, values) where values is the
+decoded tuple in the order of names. data_received_cb still works, but the
+dict is only built when it has callbacks.
+"""
+import struct
+import time
+from threading import Lock
+
+import numpy as np
+
+from cflib.crazyflie.log import LogConfig
+from cflib.crazyflie.log import LogTocElement
+from cflib.utils.callbacks import Caller
+
+# NumPy types of the log TOC types. Not np.dtype of the unpack strings: struct's
+# '<L' is 4 bytes, but NumPy reads 'L' as the platform's unsigned long.
+NUMPY_TYPES = {
+    'uint8_t': '<u1',
+    'uint16_t': '<u2',
+    'uint32_t': '<u4',
+    'int8_t': '<i1',
+    'int16_t': '<i2',
+    'int32_t': '<i4',
+    'FP16': '<f2',
+    'float': '<f4',
+}
+
+
+class BatchLogConfig(LogConfig):
+    def __init__(self, name, period_in_ms, capacity=4096, keep_columns=True):
+        """
+        capacity is the number of rows held between drains; rows that arrive
+        when it is full are dropped and counted. Without keep_columns
+        nothing is stored and only the callbacks are called.
+        """
+        super().__init__(name, period_in_ms)
+        self.capacity = capacity
+        self.keep_columns = keep_columns
+        self.tuple_received_cb = Caller()
+        self.names = None
+        self.dropped = 0
+        self._struct = None
+        self._lock = Lock()
+
+    def _compile(self):
+        # Built from fetch_as rather than the TOC elements' pytype: the packet carries every variable
+        # as it is fetched, which differs from the TOC type when a config asks for a conversion,
+        # such as a float fetched as FP16
+        codes = [LogTocElement.get_unpack_string_from_id(variable.fetch_as) for variable in self.variables]
+        self.names = [variable.name for variable in self.variables]
+        self._struct = struct.Struct('<' + ''.join(code.lstrip('<') for code in codes))
+        self.dtype = np.dtype([('timestamp', '<u4'), ('host_time', '<f8')] +
+                              [(variable.name, NUMPY_TYPES[LogTocElement.get_cstring_from_id(variable.fetch_as)])
+                               for variable in self.variables])
+        # Two buffers: one filling while the view of the other is with the consumer
+        self._buffers = [np.empty(self.capacity, self.dtype), np.empty(self.capacity, self.dtype)]
+        self._fill = 0
+
+    def start(self):
+        # The variables are final once the config is started, so the decoder is built here, not per packet
+        if self._struct is None:
+            self._compile()
+        super().start()
+
+    def unpack_log_data(self, log_data, timestamp):
+        """Called by cflib for every log packet of this config."""
+        values = self._struct.unpack_from(log_data)
+
+        if self.keep_columns:
+            with self._lock:
+                if self._fill < self.capacity:
+                    self._buffers[0][self._fill] = (timestamp, time.monotonic()) + values
+                    self._fill += 1
+                else:
+                    self.dropped += 1
+
+        if self.tuple_received_cb.callbacks:
+            self.tuple_received_cb.call(timestamp, values)
+        if self.data_received_cb.callbacks:
+            self.data_received_cb.call(timestamp, dict(zip(self.names, values)), self)
+
+    def drain(self):
+        """
+        The rows received since the last drain, oldest first, as a view of
+        a structured array, with every column even before the first packet.
+        It stays valid until the next drain.
+        """
+        if self._struct is None:
+            self._compile()
+        with self._lock:
+            batch = self._buffers[0][:self._fill]
+            self._buffers.reverse()
+            self._fill = 0
+        return batch
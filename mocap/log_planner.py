@@ -0,0 +1,185 @@
+"""
+LogConfig planning by packet size and rate.
+
+A log packet carries at most 26 bytes of variables, so one LogConfig with
+17 floats plus an FP16 cannot be started. Instead list what is wanted, each
+variable with the rate it is needed at and whether FP16 precision is enough,
+and let plan_logs split it into LogConfigs that fit:
+
+    requests = [
+        LogRequest('stateEstimate.x', 100),
+        LogRequest('stateEstimate.qx', 50, fp16=True),
+        LogRequest('pm.vbat', 1, fp16=True),
+    ]
+    plan = plan_logs(cf.log.toc, requests, name='Stabilizer')
+    plan.add_to(cf)
+    plan.data_received_cb.add_callback(log_data)
+    plan.start()
+
+Each variable is fetched as the type the TOC reports for it, so integer and
+compressed variables (such as stateEstimateZ.*) keep their small native
+size, and floats are fetched as FP16 where the request allows it. Periods
+are rounded down to the 10 ms the firmware counts in, variables with the
+same period are packed into as few configs as possible (first fit,
+largest first), and configs of the same period are started spread over
+the period so their packets do not all arrive in the same tick. The
+staggered starts run on timers, so start() returns at once and can be
+called from cflib's connected callback.
+
+The plan merges the configs back into one stream at the fastest rate:
+data_received_cb is called with (timestamp, data, plan) for every packet of
+the first config of the shortest period, data holding the latest value of
+every planned variable. The slower variables are held between their
+packets, and are NaN until their config first reports, so the stream starts
+with the first packet instead of waiting for the slowest config. It has
+name and variables like a LogConfig, so log_sink_for(plan) and
+plan.data_received_cb work together.
+"""
+import math
+import struct
+from threading import Timer
+
+from cflib.crazyflie.log import LogConfig
+from cflib.crazyflie.log import LogTocElement
+from cflib.utils.callbacks import Caller
+
+# Variable bytes in one log data packet
+LOG_PACKET_SIZE = 26
+
+# The firmware's log period unit and the largest period it accepts
+PERIOD_STEP_MS = 10
+MAX_PERIOD_MS = 2550
+
+FP16_SIZE = 2
+
+
+class LogRequest:
+    def __init__(self, name, rate_hz, fp16=False):
+        self.name = name
+        self.rate_hz = rate_hz
+        # Whether half precision is good enough for this variable
+        self.fp16 = fp16
+
+
+def period_for(rate_hz):
+    """The log period that delivers at least rate_hz, in multiples of 10 ms."""
+    period = int(1000.0 / rate_hz) // PERIOD_STEP_MS * PERIOD_STEP_MS
+    return min(max(period, PERIOD_STEP_MS), MAX_PERIOD_MS)
+
+
+def _fetch_type(toc, request):
+    """(fetch_as, size) for a request, from the TOC type of the variable."""
+    try:
+        element = toc.get_element_by_complete_name(request.name)
+    except (KeyError, ValueError):
+        element = None
+    if element is None:
+        raise KeyError(request.name)
+    if element.ctype == 'float' and request.fp16:
+        return 'FP16', FP16_SIZE
+    return element.ctype, struct.calcsize(element.pytype)
+
+
+class LogPlan:
+    def __init__(self, name, configs, offsets):
+        self.name = name
+        self.configs = configs
+        # Start delay of each config in seconds, spreading configs of the same period
+        self.offsets = offsets
+        self.variables = [variable for config in configs for variable in config.variables]
+        self.data_received_cb = Caller()
+        self.error_cb = Caller()
+        # The config whose packets emit merged samples, the first of the shortest period
+        self.clock = min(configs, key=lambda config: config.period_in_ms) if configs else None
+        self.latest = dict.fromkeys((variable.name for variable in self.variables), math.nan)
+        self.packets = 0
+        self._timers = []
+
+    def _log_data(self, timestamp, data, logconf):
+        self.latest.update(data)
+        self.packets += 1
+        if logconf is self.clock:
+            self.data_received_cb.call(timestamp, dict(self.latest), self)
+
+    def _log_error(self, logconf, msg):
+        self.error_cb.call(logconf, msg)
+
+    def add_to(self, cf):
+        """Add every config to cf's log. Raises KeyError/AttributeError like add_config."""
+        for config in self.configs:
+            cf.log.add_config(config)
+            config.data_received_cb.add_callback(self._log_data)
+            config.error_cb.add_callback(self._log_error)
+
+    def start(self):
+        """Start the configs, the staggered ones on timers; returns without waiting for them."""
+        # Nothing is held over from an earlier start
+        self.latest = dict.fromkeys(self.latest, math.nan)
+        self._cancel_timers()
+        for offset, config in zip(self.offsets, self.configs):
+            if offset > 0:
+                timer = Timer(offset, config.start)
+                timer.daemon = True
+                timer.start()
+                self._timers.append(timer)
+            else:
+                config.start()
+
+    def _cancel_timers(self):
+        for timer in self._timers:
+            timer.cancel()
+        self._timers = []
+
+    def stop(self):
+        self._cancel_timers()
+        for config in self.configs:
+            config.stop()
+
+    def delete(self):
+        for config in self.configs:
+            config.delete()
+
+    def report(self):
+        lines = ['Log plan {}: {} variables in {} configs'.format(
+            self.name, len(self.variables), len(self.configs))]
+        for offset, config in zip(self.offsets, self.configs):
+            lines.append('  {} every {} ms (+{:.0f} ms), {}'.format(
+                config.name, config.period_in_ms, offset * 1000.0,
+                ', '.join('{} {}'.format(variable.name, LogTocElement.get_cstring_from_id(variable.fetch_as))
+                          for variable in config.variables)))
+        return '\n'.join(lines)
+
+
+def plan_logs(toc, requests, name='Log', packet_size=LOG_PACKET_SIZE):
+    """
+    Split LogRequests into LogConfigs of at most packet_size bytes each.
+    Raises KeyError for a variable that is not in the TOC.
+    """
+    by_period = {}
+    for request in requests:
+        fetch_as, size = _fetch_type(toc, request)
+        by_period.setdefault(period_for(request.rate_hz), []).append((size, request.name, fetch_as))
+
+    configs = []
+    offsets = []
+    for period in sorted(by_period):
+        # First fit decreasing: bins are [free bytes, variables]
+        bins = []
+        for size, variable, fetch_as in sorted(by_period[period], key=lambda item: -item[0]):
+            for packet in bins:
+                if packet[0] >= size:
+                    break
+            else:
+                packet = [packet_size, []]
+                bins.append(packet)
+            packet[0] -= size
+            packet[1].append((variable, fetch_as))
+
+        for index, (_, variables) in enumerate(bins):
+            config = LogConfig(name='{} {} ms #{}'.format(name, period, index + 1), period_in_ms=period)
+            for variable, fetch_as in variables:
+                config.add_variable(variable, fetch_as)
+            configs.append(config)
+            offsets.append(period / 1000.0 * index / len(bins))
+
+    return LogPlan(name, configs, offsets)
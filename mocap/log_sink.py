@@ -0,0 +1,196 @@
+"""
+Binary columnar log sink.
+
+The logging callbacks printed every sample with f-strings, which at 100 Hz
+makes stdout the bottleneck and keeps nothing for analysis. A
+ColumnarLogSink appends each sample as one row of a preallocated NumPy
+structured array: the drone timestamp, the host receive time and one column
+per log variable. Full chunks are handed to a background thread that appends
+them to .npy files, so the flight log can be opened later with
+np.load(path, mmap_mode='r') or load_log:
+
+    sink = log_sink_for(log_config)
+    log_config.data_received_cb.add_callback(sink.log_data)
+    ...
+    sink.close()
+    data = load_log('flight_logs', 'Stabilizer')
+    data['stateEstimate.z'], data['timestamp']
+
+With print_every, append also prints every print_every-th sample, so the
+console shows the flight going by without being the bottleneck:
+
+    sink = log_sink_for(log_config, print_every=10)
+
+A file is closed and the next one started once it reaches max_file_bytes.
+Memory is bounded to max_chunks chunks: when the writer falls that far
+behind, the chunk being filled is dropped and counted instead of growing a
+queue.
+"""
+import glob
+import os
+import queue
+import struct
+import time
+from threading import Thread
+
+import numpy as np
+
+# Every row starts with the drone's log timestamp (ms) and the host monotonic receive time (s)
+TIME_FIELDS = [('timestamp', '<u4'), ('host_time', '<f8')]
+
+# npy version 1.0 header, with the row count written at a fixed width so it can be updated in place
+NPY_MAGIC = b'\x93NUMPY\x01\x00'
+NPY_ALIGN = 64
+
+
+def _npy_header(dtype, rows):
+    header = "{{'descr': {!r}, 'fortran_order': False, 'shape': ({:20d},), }}".format(
+        np.lib.format.dtype_to_descr(dtype), rows)
+    padding = -(len(NPY_MAGIC) + 2 + len(header) + 1) % NPY_ALIGN
+    header = header + ' ' * padding + '\n'
+    return NPY_MAGIC + struct.pack('<H', len(header)) + header.encode('latin1')
+
+
+class ColumnarLogSink:
+    def __init__(self, directory, name, fields, chunk_rows=1024, max_chunks=8,
+                 max_file_bytes=64 * 1024 * 1024, print_every=0):
+        """
+        fields are the log variable names, stored as float32, or
+        (name, dtype) pairs. print_every=0 prints nothing.
+        """
+        self.directory = directory
+        self.name = name
+        self.print_every = print_every
+        self.names = [field if isinstance(field, str) else field[0] for field in fields]
+        self.dtype = np.dtype(TIME_FIELDS + [(field, '<f4') if isinstance(field, str) else tuple(field)
+                                             for field in fields])
+        self.chunk_rows = chunk_rows
+        self.max_file_bytes = max_file_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._prefix = os.path.join(directory, '{}_{}'.format(name, time.strftime('%Y%m%d-%H%M%S')))
+
+        self._free = queue.Queue()
+        for _ in range(max_chunks - 1):
+            self._free.put(np.empty(chunk_rows, self.dtype))
+        self._full = queue.Queue()
+        self._chunk = np.empty(chunk_rows, self.dtype)
+        self._fill = 0
+
+        self.rows = 0
+        self.dropped = 0
+        self.written = 0
+        self.files = []
+        self._file = None
+        self._file_rows = 0
+        self._closed = False
+        self._writer = Thread(target=self._write_chunks, daemon=True)
+        self._writer.start()
+
+    def append(self, timestamp, data, host_time=None):
+        """Add one sample, data being the dict of a log callback."""
+        if host_time is None:
+            host_time = time.monotonic()
+        self._chunk[self._fill] = (timestamp, host_time) + tuple(data[name] for name in self.names)
+        self._fill += 1
+        self.rows += 1
+        if self._fill == self.chunk_rows:
+            self._hand_over()
+        if self.print_every and (self.rows - 1) % self.print_every == 0:
+            print('[{}][{}]: {}'.format(timestamp, self.name, ' '.join(
+                '{}: {:3.3f}'.format(name, data[name]) for name in self.names)))
+
+    def _hand_over(self):
+        try:
+            chunk = self._free.get_nowait()
+        except queue.Empty:
+            # The writer is max_chunks behind, drop this chunk rather than grow
+            self.dropped += self._fill
+        else:
+            self._full.put((self._chunk, self._fill))
+            self._chunk = chunk
+        self._fill = 0
+
+    def append_batch(self, batch):
+        """Add the rows of a structured array with timestamp, host_time and the sink's columns."""
+        start = 0
+        while start < len(batch):
+            rows = min(len(batch) - start, self.chunk_rows - self._fill)
+            for name in self.dtype.names:
+                self._chunk[name][self._fill:self._fill + rows] = batch[name][start:start + rows]
+            self._fill += rows
+            self.rows += rows
+            start += rows
+            if self._fill == self.chunk_rows:
+                self._hand_over()
+
+    def log_data(self, timestamp, data, logconf):
+        """Log callback, for data_received_cb.add_callback."""
+        self.append(timestamp, data)
+
+    def _open_file(self):
+        path = '{}_{:03d}.npy'.format(self._prefix, len(self.files))
+        self._file = open(path, 'wb')
+        self._file.write(_npy_header(self.dtype, 0))
+        self._file_rows = 0
+        self.files.append(path)
+
+    def _close_file(self):
+        self._file.close()
+        self._file = None
+
+    def _write_chunk(self, chunk, rows):
+        if self._file is None:
+            self._open_file()
+        self._file.write(chunk[:rows].tobytes())
+        self._file_rows += rows
+        self.written += rows
+        # Keep the header's row count current, so the file is readable even if the script dies
+        end = self._file.tell()
+        self._file.seek(0)
+        self._file.write(_npy_header(self.dtype, self._file_rows))
+        self._file.seek(end)
+        self._file.flush()
+        if end >= self.max_file_bytes:
+            self._close_file()
+
+    def _write_chunks(self):
+        while True:
+            item = self._full.get()
+            if item is None:
+                break
+            chunk, rows = item
+            self._write_chunk(chunk, rows)
+            if chunk is not self._chunk:
+                self._free.put(chunk)
+        if self._file is not None:
+            self._close_file()
+
+    def close(self):
+        """Write what is left and wait for the writer."""
+        if self._closed:
+            return
+        self._closed = True
+        if self._fill:
+            self._full.put((self._chunk, self._fill))
+            self._fill = 0
+        self._full.put(None)
+        self._writer.join()
+        print(self.report())
+
+    def report(self):
+        return 'Log {}: {} samples, {} written to {} file(s), {} dropped'.format(
+            self.name, self.rows, self.written, len(self.files), self.dropped)
+
+
+def log_sink_for(log_config, directory='flight_logs', **kwargs):
+    """A ColumnarLogSink with a column for every variable of log_config."""
+    return ColumnarLogSink(directory, log_config.name, [variable.name for variable in log_config.variables],
+                           **kwargs)
+
+
+def load_log(directory, name):
+    """All rows logged under name in directory, oldest file first, as one structured array."""
+    paths = sorted(glob.glob(os.path.join(directory, '{}_*.npy'.format(name))))
+    if not paths:
+        raise IOError('No {} logs in {}'.format(name, directory))
+    return np.concatenate([np.load(path, mmap_mode='r') for path in paths])
@@ -0,0 +1,208 @@
+"""
+Declarative missions for the high level commander.
+
+A mission is a list of steps, each a dict naming a high level command and
+its arguments. Trajectories are referenced by their name in the trajectory
+library:
+
+    mission = [
+        {'command': 'takeoff', 'height': 1.0, 'duration': 2.0},
+        {'command': 'trajectory', 'name': 'figure8', 'time_scale': 'auto'},
+        {'command': 'go_to', 'x': -0.1, 'y': 0.1, 'z': 0.5, 'yaw': 0.0, 'duration': 2.0, 'wait': 3.0},
+        {'command': 'land', 'height': 0.0, 'duration': 2.0},
+    ]
+    MissionExecutor(cf, library, limits=flight_limits).run(mission)
+
+Commands are takeoff, trajectory, go_to, land and hover (do nothing for
+duration). The next step is due when the previous one's duration has passed
+(the scaled trajectory duration for trajectories), or after 'wait' seconds if
+given. time_scale 'auto' picks the fastest scale within the executor's
+limits, DEFAULT_LIMITS unless given. Missions can also be loaded from JSON
+files with load_mission.
+
+Before takeoff the executor validates the mission, uploads and defines
+every referenced trajectory, and computes the whole timeline. In flight it
+only issues each command at its deadline, and stop() at the end. Given a
+FlightSequencer, run() instead flies the steps as sequencer phases, each
+ending when the state estimate shows it is done, with the planned waits
+reported as the padded times:
+
+    MissionExecutor(cf, library).run(mission, sequencer=FlightSequencer(cf))
+"""
+import json
+import math
+import time
+
+from flight_sequencer import Phase
+from flight_sequencer import go_to_phase
+from flight_sequencer import land_phase
+from flight_sequencer import takeoff_phase
+from flight_sequencer import trajectory_phase
+from trajectory_analysis import DEFAULT_LIMITS
+from trajectory_analysis import feasible_time_scale
+
+# command -> (required arguments, optional arguments with defaults)
+COMMANDS = {
+    'takeoff': (('height', 'duration'), {}),
+    'trajectory': (('name',), {'time_scale': 1.0, 'relative': True}),
+    'go_to': (('x', 'y', 'z', 'yaw', 'duration'), {'relative': False}),
+    'land': (('height', 'duration'), {}),
+    'hover': (('duration',), {}),
+}
+
+
+def load_mission(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+class TimelineStep:
+    def __init__(self, offset, command, arguments, wait):
+        self.offset = offset
+        self.command = command
+        self.arguments = arguments
+        self.wait = wait
+
+    def __str__(self):
+        return '{:+8.2f} s  {}({})'.format(self.offset, self.command, ', '.join(
+            '{}={}'.format(name, value) for name, value in self.arguments.items()))
+
+
+class MissionExecutor:
+    def __init__(self, cf, library, limits=DEFAULT_LIMITS):
+        self.cf = cf
+        self.library = library
+        self.limits = limits
+
+    def _validated(self, step):
+        command = step.get('command')
+        if command not in COMMANDS:
+            raise ValueError('Unknown mission command {!r} in {}'.format(command, step))
+        required, optional = COMMANDS[command]
+        missing = [name for name in required if name not in step]
+        if missing:
+            raise ValueError('Mission step {} is missing {}'.format(step, ', '.join(missing)))
+        unknown = set(step) - set(required) - set(optional) - {'command', 'wait'}
+        if unknown:
+            raise ValueError('Mission step {} has unknown arguments {}'.format(step, ', '.join(sorted(unknown))))
+        if command == 'trajectory' and step['name'] not in self.library.entries:
+            raise ValueError('Mission trajectory {!r} is not in the trajectory library'.format(step['name']))
+
+        arguments = {name: value for name, value in step.items() if name not in ('command', 'wait')}
+        for name, value in optional.items():
+            arguments.setdefault(name, value)
+        return command, arguments
+
+    def prefetch(self, mission):
+        """
+        Upload and define every trajectory the mission refers to. Each name
+        has its own trajectory id, so all of them stay defined at once.
+        """
+        names = []
+        for step in mission:
+            if step.get('command') == 'trajectory' and step['name'] not in names:
+                names.append(step['name'])
+        for name in names:
+            self.library.select(name)
+        # Loading a later trajectory may have evicted an earlier one
+        evicted = [name for name in names if not self.library.entries[name].resident]
+        if evicted:
+            raise ValueError('Mission trajectories do not fit in trajectory memory together, {} evicted'.format(
+                ', '.join(evicted)))
+
+    def plan(self, mission):
+        """The timeline of the mission: a TimelineStep per step, with its offset from takeoff."""
+        timeline = []
+        offset = 0.0
+        for step in mission:
+            command, arguments = self._validated(step)
+            if command == 'trajectory':
+                entry = self.library.entries[arguments['name']]
+                if arguments['time_scale'] == 'auto':
+                    scale = feasible_time_scale(entry.trajectory, self.limits,
+                                                label='Trajectory {}'.format(entry.name))
+                    # Rounded up, a scale rounded down would break the limits
+                    arguments['time_scale'] = math.ceil(scale * 1000.0) / 1000.0
+                duration = entry.duration * arguments['time_scale']
+            else:
+                duration = arguments['duration']
+            wait = step.get('wait', duration)
+            timeline.append(TimelineStep(offset, command, arguments, wait))
+            offset += wait
+        timeline.append(TimelineStep(offset, 'stop', {}, 0.0))
+        return timeline
+
+    def _issue(self, step):
+        commander = self.cf.high_level_commander
+        arguments = step.arguments
+        if step.command == 'takeoff':
+            commander.takeoff(arguments['height'], arguments['duration'])
+        elif step.command == 'trajectory':
+            trajectory_id = self.library.entries[arguments['name']].trajectory_id
+            commander.start_trajectory(trajectory_id, arguments['time_scale'], arguments['relative'])
+        elif step.command == 'go_to':
+            commander.go_to(arguments['x'], arguments['y'], arguments['z'], arguments['yaw'],
+                            arguments['duration'], arguments['relative'])
+        elif step.command == 'land':
+            commander.land(arguments['height'], arguments['duration'])
+        elif step.command == 'stop':
+            commander.stop()
+
+    def phases(self, timeline):
+        """FlightSequencer phases for the steps of a timeline, without the final stop."""
+        commander = self.cf.high_level_commander
+        phases = []
+        for step in timeline:
+            arguments = step.arguments
+            if step.command == 'takeoff':
+                phases.append(takeoff_phase(commander, arguments['height'], arguments['duration'],
+                                            padded=step.wait))
+            elif step.command == 'trajectory':
+                entry = self.library.entries[arguments['name']]
+                phases.append(trajectory_phase(commander, entry.trajectory_id, entry.duration,
+                                               arguments['time_scale'], arguments['relative'], padded=step.wait))
+            elif step.command == 'go_to':
+                phases.append(go_to_phase(commander, arguments['x'], arguments['y'], arguments['z'],
+                                          arguments['yaw'], arguments['duration'], arguments['relative'],
+                                          padded=step.wait))
+            elif step.command == 'land':
+                phases.append(land_phase(commander, arguments['height'], arguments['duration'], padded=step.wait))
+            elif step.command == 'hover':
+                duration = arguments['duration']
+                phases.append(Phase('hover', lambda: None,
+                                    lambda state, elapsed, sequencer, duration=duration: elapsed >= duration,
+                                    timeout=duration + 1.0, padded=step.wait))
+        return phases
+
+    def run(self, mission, timeline=None, sequencer=None):
+        """
+        Validate, prefetch and plan the mission, then fly it. A timeline
+        from an earlier plan() can be passed in to skip planning. Returns
+        the lateness in seconds of each issued command, or with a
+        sequencer the PhaseResults of its steps.
+        """
+        if timeline is None:
+            timeline = self.plan(mission)
+        self.prefetch(mission)
+        print('Mission timeline, {:.2f} s:'.format(timeline[-1].offset))
+        for step in timeline:
+            print('  {}'.format(step))
+
+        if sequencer is not None:
+            try:
+                return sequencer.run(self.phases(timeline))
+            finally:
+                self.cf.high_level_commander.stop()
+
+        lateness = []
+        start = time.monotonic()
+        for step in timeline:
+            remaining = start + step.offset - time.monotonic()
+            if remaining > 0:
+                time.sleep(remaining)
+            lateness.append(time.monotonic() - start - step.offset)
+            self._issue(step)
+
+        print('Mission flown, commands issued at most {:.1f} ms after their deadlines'.format(
+            max(lateness) * 1000.0))
+        return lateness
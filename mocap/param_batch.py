@@ -0,0 +1,133 @@
+"""
+Batched, acknowledged parameter writes.
+
+The scripts call cf.param.set_value one parameter at a time and follow it
+with a fixed time.sleep, hoping the write has landed. apply_params queues a
+whole batch at once (cflib's parameter updater sends them back to back as
+each one is acknowledged) and then waits for the update callbacks of all of
+them together, so the batch costs one round of confirmations and no padding.
+
+Writes whose value already matches cflib's parameter cache are skipped.
+Trigger parameters such as kalman.resetEstimation are always written, since
+the firmware clears them behind the cache's back. A trigger written again in
+the same batch, such as the 1 -> 0 of a reset, waits until its previous
+write is confirmed and then trigger_hold seconds, so the firmware acts on
+the 1 before it is cleared.
+"""
+import math
+import time
+from threading import Condition
+
+TRIGGER_PARAMS = ('kalman.resetEstimation',)
+
+# Seconds a trigger parameter is held before it is written again
+TRIGGER_HOLD = 0.1
+
+
+class ParamApplyResult:
+    def __init__(self, written, skipped, duration, confirmed):
+        self.written = written
+        self.skipped = skipped
+        self.duration = duration
+        self.confirmed = confirmed
+
+    def __str__(self):
+        return '{} written, {} skipped in {:.1f} ms{}'.format(
+            len(self.written), len(self.skipped), self.duration * 1000.0,
+            '' if self.confirmed else ' (NOT all confirmed)')
+
+
+def cached_value(cf, complete_name):
+    """The value cflib last saw for the parameter, as a string, or None."""
+    group, name = complete_name.split('.', 1)
+    return cf.param.values.get(group, {}).get(name)
+
+
+def same_value(a, b):
+    """Compare parameter values numerically, allowing for float32 rounding."""
+    try:
+        return math.isclose(float(a), float(b), rel_tol=1e-6, abs_tol=1e-12)
+    except (TypeError, ValueError):
+        return str(a) == str(b)
+
+
+def plan_writes(cf, writes, triggers=TRIGGER_PARAMS):
+    """
+    Reduce an ordered list of (complete_name, value) writes to the ones that
+    need to be sent. For ordinary parameters only the last value matters; it
+    is dropped if the cache already holds it. Trigger parameters are sent
+    exactly as requested.
+    Returns (to_send, skipped) lists of (complete_name, value).
+    """
+    last_index = {}
+    for index, (name, value) in enumerate(writes):
+        if name not in triggers:
+            last_index[name] = index
+
+    to_send = []
+    skipped = []
+    for index, (name, value) in enumerate(writes):
+        if name in triggers:
+            to_send.append((name, value))
+        elif last_index[name] != index:
+            skipped.append((name, value))
+        elif same_value(cached_value(cf, name), value):
+            skipped.append((name, value))
+        else:
+            to_send.append((name, value))
+
+    return to_send, skipped
+
+
+def apply_params(cf, writes, timeout=2.0, label='Parameters', triggers=TRIGGER_PARAMS,
+                 trigger_hold=TRIGGER_HOLD):
+    """
+    Write a batch of (complete_name, value) parameters in order and wait until
+    the Crazyflie has confirmed all of them, or timeout seconds have passed.
+    Returns a ParamApplyResult; confirmed is False on timeout.
+    """
+    start = time.monotonic()
+    deadline = start + timeout
+    to_send, skipped = plan_writes(cf, writes, triggers)
+
+    pending = {}
+    for name, value in to_send:
+        pending[name] = pending.get(name, 0) + 1
+    writes_of = dict(pending)
+
+    condition = Condition()
+
+    def _updated(complete_name, value):
+        with condition:
+            if pending.get(complete_name, 0) > 0:
+                pending[complete_name] -= 1
+                condition.notify_all()
+
+    callbacks = []
+    for complete_name in pending:
+        group, name = complete_name.split('.', 1)
+        cf.param.add_update_callback(group=group, name=name, cb=_updated)
+        callbacks.append((group, name))
+
+    try:
+        sent = {}
+        for name, value in to_send:
+            if name in triggers and sent.get(name):
+                # The earlier write of the trigger has to land and take effect first
+                with condition:
+                    condition.wait_for(lambda: writes_of[name] - pending[name] >= sent[name],
+                                       max(0.0, deadline - time.monotonic()))
+                time.sleep(trigger_hold)
+            cf.param.set_value(name, value)
+            sent[name] = sent.get(name, 0) + 1
+
+        with condition:
+            confirmed = condition.wait_for(lambda: not any(pending.values()),
+                                           max(0.0, deadline - time.monotonic()))
+    finally:
+        for group, name in callbacks:
+            cf.param.remove_update_callback(group=group, name=name, cb=_updated)
+
+    result = ParamApplyResult(to_send, skipped, time.monotonic() - start, confirmed)
+    print('{}: {}'.format(label, result))
+    return result
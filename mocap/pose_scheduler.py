@@ -0,0 +1,217 @@
+"""
+Fixed-rate extpose transmission for the mocap scripts.
+
+The mocap wrappers (motioncapture, QTM and the Vicon UDP relay) call on_pose
+whenever a frame happens to arrive, so the Kalman estimator sees bursts and
+gaps. PoseScheduler decouples the two: on_pose only records the frame, and a
+dedicated thread sends the resampled pose on a monotonic deadline grid.
+
+Usage, with any of the wrappers:
+
+    scheduler = PoseScheduler(
+        lambda pose: send_extpose_quat(cf, pose[0], pose[1], pose[2], pose[3]),
+        rate_hz=100)
+    mocap_wrapper.on_pose = scheduler.on_pose
+    ...
+    scheduler.close()
+    print(scheduler.report())
+"""
+import bisect
+import time
+from collections import deque
+from threading import Lock
+from threading import Thread
+
+
+class LatenessHistogram:
+    """
+    Histogram of how late each tick fired relative to its deadline.
+    Bucket edges are in milliseconds; the last bucket is open ended.
+    """
+
+    DEFAULT_EDGES_MS = (0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 20.0)
+
+    def __init__(self, edges_ms=DEFAULT_EDGES_MS):
+        self.edges_ms = tuple(edges_ms)
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * (len(self.edges_ms) + 1)
+        self.ticks = 0
+        self.missed = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def record(self, lateness):
+        """Record the lateness of one tick, given in seconds."""
+        lateness_ms = max(lateness, 0.0) * 1000.0
+        self.counts[bisect.bisect_left(self.edges_ms, lateness_ms)] += 1
+        self.ticks += 1
+        self.total_ms += lateness_ms
+        if lateness_ms > self.max_ms:
+            self.max_ms = lateness_ms
+
+    def mean_ms(self):
+        if self.ticks == 0:
+            return 0.0
+        return self.total_ms / self.ticks
+
+    def report(self):
+        lines = ['{} ticks, {} missed, lateness mean {:.3f} ms, max {:.3f} ms'.format(
+            self.ticks, self.missed, self.mean_ms(), self.max_ms)]
+        lower = 0.0
+        for edge, count in zip(self.edges_ms + (float('inf'),), self.counts):
+            lines.append('  {:>7.2f} - {:>7.2f} ms: {}'.format(lower, edge, count))
+            lower = edge
+        return '\n'.join(lines)
+
+
+class DeadlineTicker:
+    """
+    Monotonic clock that wakes up at start + k * period. Deadlines are
+    computed from the start time rather than from the previous wake-up, so
+    sleep overshoot never accumulates into drift.
+    """
+
+    def __init__(self, rate_hz, histogram=None):
+        self.period = 1.0 / rate_hz
+        self.histogram = histogram if histogram is not None else LatenessHistogram()
+        self._start = None
+        self._tick = 0
+
+    def start(self, now=None):
+        self._start = time.monotonic() if now is None else now
+        self._tick = 0
+
+    def wait(self):
+        """
+        Sleep until the next deadline and return it. Ticks that were missed
+        entirely (lateness of more than one period) are skipped rather than
+        sent back to back, and counted as missed in the histogram.
+        """
+        if self._start is None:
+            self.start()
+
+        deadline = self._start + self._tick * self.period
+        remaining = deadline - time.monotonic()
+        if remaining > 0:
+            time.sleep(remaining)
+
+        lateness = time.monotonic() - deadline
+        self.histogram.record(lateness)
+        self._tick += 1
+
+        if lateness >= self.period:
+            skipped = int(lateness // self.period)
+            self._tick += skipped
+            self.histogram.missed += skipped
+
+        return deadline
+
+
+class PoseScheduler(Thread):
+    """
+    Sends the latest mocap pose at a fixed rate.
+
+    Poses are [x, y, z, orientation] lists as produced by the wrappers. The
+    orientation is passed through untouched (quaternion object or rotation
+    matrix, depending on the mocap system), only the position is resampled.
+
+    HOLD sends the most recent frame on every tick. INTERPOLATE samples the
+    frame history interpolation_delay seconds in the past and linearly
+    interpolates the position between the two surrounding frames, which
+    smooths out irregular frame arrival at the cost of that delay.
+    """
+
+    HOLD = 'hold'
+    INTERPOLATE = 'interpolate'
+
+    def __init__(self, send_pose, rate_hz=100.0, mode=HOLD,
+                 interpolation_delay=0.01, max_age=0.5):
+        Thread.__init__(self, daemon=True)
+
+        if mode not in (self.HOLD, self.INTERPOLATE):
+            raise ValueError('Unknown resample mode {}'.format(mode))
+
+        self.send_pose = send_pose
+        self.mode = mode
+        self.interpolation_delay = interpolation_delay
+        self.max_age = max_age
+        self.ticker = DeadlineTicker(rate_hz)
+
+        self.frames_received = 0
+        self.ticks_sent = 0
+        self.stale_ticks = 0
+
+        self._frames = deque(maxlen=16)
+        self._lock = Lock()
+        self._stay_open = True
+
+        self.start()
+
+    def on_pose(self, pose):
+        """Callback for the mocap wrappers, only records the frame."""
+        now = time.monotonic()
+        with self._lock:
+            self._frames.append((now, pose))
+            self.frames_received += 1
+
+    def latest(self):
+        """The most recently received pose, or None if there is none yet."""
+        with self._lock:
+            if not self._frames:
+                return None
+            return self._frames[-1][1]
+
+    def sample(self, t):
+        """
+        Resample the pose at monotonic time t. Returns None if no frame has
+        been received within max_age, so a lost mocap stream stops feeding
+        the estimator instead of repeating a stale pose forever.
+        """
+        with self._lock:
+            frames = list(self._frames)
+
+        if not frames:
+            return None
+
+        newest_time, newest = frames[-1]
+        if t - newest_time > self.max_age:
+            return None
+
+        if self.mode == self.HOLD:
+            return newest
+
+        t = t - self.interpolation_delay
+        if t >= newest_time or len(frames) < 2:
+            return newest
+
+        for (t0, pose0), (t1, pose1) in zip(frames[-2::-1], frames[:0:-1]):
+            if t0 <= t:
+                alpha = (t - t0) / (t1 - t0) if t1 > t0 else 1.0
+                orientation = pose1[3] if alpha >= 0.5 else pose0[3]
+                return [pose0[i] + alpha * (pose1[i] - pose0[i]) for i in range(3)] + [orientation]
+
+        # Older than anything in the history, use the oldest frame we have
+        return frames[0][1]
+
+    def close(self):
+        self._stay_open = False
+        self.join()
+
+    def run(self):
+        self.ticker.start()
+        while self._stay_open:
+            deadline = self.ticker.wait()
+            pose = self.sample(deadline)
+            if pose is None:
+                self.stale_ticks += 1
+                continue
+
+            self.send_pose(pose)
+            self.ticks_sent += 1
+
+    def report(self):
+        return 'Pose scheduler: {} frames in, {} sent, {} stale ticks\n{}'.format(
+            self.frames_received, self.ticks_sent, self.stale_ticks,
+            self.ticker.histogram.report())
@@ -29,7 +29,6 @@ rigid_body_name to match the name of the Crazyflie in QTM.
 """
 import asyncio
 import math
-import time
 import xml.etree.cElementTree as ET
 from threading import Thread
 
@@ -38,13 +37,22 @@ from scipy.spatial.transform import Rotation
 
 import cflib.crtp
 from cflib.crazyflie import Crazyflie
-from cflib.crazyflie.log import LogConfig
-from cflib.crazyflie.mem import MemoryElement
-from cflib.crazyflie.mem import Poly4D
 from cflib.crazyflie.syncCrazyflie import SyncCrazyflie
-from cflib.crazyflie.syncLogger import SyncLogger
 from cflib.utils import uri_helper
 
+from estimator_convergence import wait_for_convergence
+from estimator_warm_start import warm_start_estimator
+from flight_sequencer import FlightSequencer
+from flight_sequencer import land_phase
+from flight_sequencer import takeoff_phase
+from flight_sequencer import trajectory_phase
+from param_batch import apply_params
+from pose_scheduler import PoseScheduler
+from trajectory_analysis import TrajectoryLimits
+from trajectory_analysis import feasible_time_scale
+from trajectory_loader import load_named_trajectory
+from trajectory_memory import upload_trajectory
+
 # URI to the Crazyflie to connect to
 uri = uri_helper.uri_from_env(default='radio://0/80/2M/E7E7E7E7E7')
 
@@ -58,23 +66,25 @@ send_full_pose = True
 # degrees. If this is a problem, increase orientation_std_dev a bit. The default value in the firmware is 4.5e-3.
 orientation_std_dev = 8.0e-3
 
+# Rate at which QTM poses are forwarded to the estimator, independent of the
+# QTM frame rate. Use PoseScheduler.INTERPOLATE to smooth irregular frames.
+extpose_rate_hz = 100
+extpose_resample_mode = PoseScheduler.HOLD
+
+# Kalman variance sampling used to detect estimator convergence. The variances
+# must stay within the threshold for estimator_window consecutive samples.
+estimator_log_period_ms = 100
+estimator_window = 10
+
+# Trajectories are time scaled as fast as these limits allow (m/s, m/s^2)
+flight_limits = TrajectoryLimits(max_velocity=1.5, max_acceleration=4.0)
+
 # The trajectory to fly
 # See https://github.com/whoenig/uav_trajectories for a tool to generate
 # trajectories
 
 # Duration,x^0,x^1,x^2,x^3,x^4,x^5,x^6,x^7,y^0,y^1,y^2,y^3,y^4,y^5,y^6,y^7,z^0,z^1,z^2,z^3,z^4,z^5,z^6,z^7,yaw^0,yaw^1,yaw^2,yaw^3,yaw^4,yaw^5,yaw^6,yaw^7
-figure8 = [
-    [1.050000, 0.000000, -0.000000, 0.000000, -0.000000, 0.830443, -0.276140, -0.384219, 0.180493, -0.000000, 0.000000, -0.000000, 0.000000, -1.356107, 0.688430, 0.587426, -0.329106, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000],  # noqa
-    [0.710000, 0.396058, 0.918033, 0.128965, -0.773546, 0.339704, 0.034310, -0.026417, -0.030049, -0.445604, -0.684403, 0.888433, 1.493630, -1.361618, -0.139316, 0.158875, 0.095799, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000],  # noqa
-    [0.620000, 0.922409, 0.405715, -0.582968, -0.092188, -0.114670, 0.101046, 0.075834, -0.037926, -0.291165, 0.967514, 0.421451, -1.086348, 0.545211, 0.030109, -0.050046, -0.068177, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000],  # noqa
-    [0.700000, 0.923174, -0.431533, -0.682975, 0.177173, 0.319468, -0.043852, -0.111269, 0.023166, 0.289869, 0.724722, -0.512011, -0.209623, -0.218710, 0.108797, 0.128756, -0.055461, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000],  # noqa
-    [0.560000, 0.405364, -0.834716, 0.158939, 0.288175, -0.373738, -0.054995, 0.036090, 0.078627, 0.450742, -0.385534, -0.954089, 0.128288, 0.442620, 0.055630, -0.060142, -0.076163, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000],  # noqa
-    [0.560000, 0.001062, -0.646270, -0.012560, -0.324065, 0.125327, 0.119738, 0.034567, -0.063130, 0.001593, -1.031457, 0.015159, 0.820816, -0.152665, -0.130729, -0.045679, 0.080444, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000],  # noqa
-    [0.700000, -0.402804, -0.820508, -0.132914, 0.236278, 0.235164, -0.053551, -0.088687, 0.031253, -0.449354, -0.411507, 0.902946, 0.185335, -0.239125, -0.041696, 0.016857, 0.016709, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000],  # noqa
-    [0.620000, -0.921641, -0.464596, 0.661875, 0.286582, -0.228921, -0.051987, 0.004669, 0.038463, -0.292459, 0.777682, 0.565788, -0.432472, -0.060568, -0.082048, -0.009439, 0.041158, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000],  # noqa
-    [0.710000, -0.923935, 0.447832, 0.627381, -0.259808, -0.042325, -0.032258, 0.001420, 0.005294, 0.288570, 0.873350, -0.515586, -0.730207, -0.026023, 0.288755, 0.215678, -0.148061, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000],  # noqa
-    [1.053185, -0.398611, 0.850510, -0.144007, -0.485368, -0.079781, 0.176330, 0.234482, -0.153567, 0.447039, -0.532729, -0.855023, 0.878509, 0.775168, -0.391051, -0.713519, 0.391628, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000],  # noqa
-]
+figure8 = load_named_trajectory('figure8.csv')
 
 
 class QtmWrapper(Thread):
@@ -155,44 +165,8 @@ class QtmWrapper(Thread):
 
 
 def wait_for_position_estimator(scf):
-    print('Waiting for estimator to find position...')
-
-    log_config = LogConfig(name='Kalman Variance', period_in_ms=500)
-    log_config.add_variable('kalman.varPX', 'float')
-    log_config.add_variable('kalman.varPY', 'float')
-    log_config.add_variable('kalman.varPZ', 'float')
-
-    var_y_history = [1000] * 10
-    var_x_history = [1000] * 10
-    var_z_history = [1000] * 10
-
-    threshold = 0.001
-
-    with SyncLogger(scf, log_config) as logger:
-        for log_entry in logger:
-            data = log_entry[1]
-
-            var_x_history.append(data['kalman.varPX'])
-            var_x_history.pop(0)
-            var_y_history.append(data['kalman.varPY'])
-            var_y_history.pop(0)
-            var_z_history.append(data['kalman.varPZ'])
-            var_z_history.pop(0)
-
-            min_x = min(var_x_history)
-            max_x = max(var_x_history)
-            min_y = min(var_y_history)
-            max_y = max(var_y_history)
-            min_z = min(var_z_history)
-            max_z = max(var_z_history)
-
-            # print("{} {} {}".
-            #       format(max_x - min_x, max_y - min_y, max_z - min_z))
-
-            if (max_x - min_x) < threshold and (
-                    max_y - min_y) < threshold and (
-                    max_z - min_z) < threshold:
-                break
+    return wait_for_convergence(scf, period_in_ms=estimator_log_period_ms,
+                                window=estimator_window, threshold=0.001)
 
 
 def _sqrt(a):
@@ -220,59 +194,51 @@ def send_extpose_rot_matrix(cf, x, y, z, rot):
 
 
 def reset_estimator(cf):
-    cf.param.set_value('kalman.resetEstimation', '1')
-    time.sleep(0.1)
-    cf.param.set_value('kalman.resetEstimation', '0')
+    apply_params(cf, [('kalman.resetEstimation', '1'),
+                      ('kalman.resetEstimation', '0')], label='Estimator reset')
 
     # time.sleep(1)
     wait_for_position_estimator(cf)
 
 
-def adjust_orientation_sensitivity(cf):
-    cf.param.set_value('locSrv.extQuatStdDev', orientation_std_dev)
+def orientation_sensitivity_params():
+    return [('locSrv.extQuatStdDev', orientation_std_dev)]
 
 
-def activate_kalman_estimator(cf):
-    cf.param.set_value('stabilizer.estimator', '2')
+def kalman_estimator_params():
+    return [
+        ('stabilizer.estimator', '2'),
+        # Set the std deviation for the quaternion data pushed into the
+        # kalman filter. The default value seems to be a bit too low.
+        ('locSrv.extQuatStdDev', 0.06),
+    ]
 
-    # Set the std deviation for the quaternion data pushed into the
-    # kalman filter. The default value seems to be a bit too low.
-    cf.param.set_value('locSrv.extQuatStdDev', 0.06)
 
+def mellinger_controller_params():
+    return [('stabilizer.controller', '2')]
 
-def activate_mellinger_controller(cf):
-    cf.param.set_value('stabilizer.controller', '2')
+
+def adjust_orientation_sensitivity(cf):
+    apply_params(cf, orientation_sensitivity_params())
 
 
-def upload_trajectory(cf, trajectory_id, trajectory):
-    trajectory_mem = cf.mem.get_mems(MemoryElement.TYPE_TRAJ)[0]
-    trajectory_mem.trajectory = []
+def activate_kalman_estimator(cf):
+    apply_params(cf, kalman_estimator_params())
 
-    total_duration = 0
-    for row in trajectory:
-        duration = row[0]
-        x = Poly4D.Poly(row[1:9])
-        y = Poly4D.Poly(row[9:17])
-        z = Poly4D.Poly(row[17:25])
-        yaw = Poly4D.Poly(row[25:33])
-        trajectory_mem.trajectory.append(Poly4D(duration, x, y, z, yaw))
-        total_duration += duration
 
-    trajectory_mem.write_data_sync()
-    cf.high_level_commander.define_trajectory(trajectory_id, 0, len(trajectory_mem.trajectory))
-    return total_duration
+def activate_mellinger_controller(cf):
+    apply_params(cf, mellinger_controller_params())
 
 
-def run_sequence(cf, trajectory_id, duration):
+def run_sequence(cf, trajectory_id, duration, time_scale=1.0):
     commander = cf.high_level_commander
 
-    commander.takeoff(1.0, 2.0)
-    time.sleep(3.0)
-    relative = True
-    commander.start_trajectory(trajectory_id, 1.0, relative)
-    time.sleep(duration)
-    commander.land(0.0, 2.0)
-    time.sleep(2)
+    # Each phase ends when the state estimate says it is done, not after a fixed sleep
+    FlightSequencer(cf).run([
+        takeoff_phase(commander, 1.0, 2.0),
+        trajectory_phase(commander, trajectory_id, duration, time_scale, relative=True),
+        land_phase(commander, 0.0, 2.0),
+    ])
     commander.stop()
 
 
@@ -286,16 +252,23 @@ if __name__ == '__main__':
         cf = scf.cf
         trajectory_id = 1
 
-        # Set up a callback to handle data from QTM
-        qtm_wrapper.on_pose = lambda pose: send_extpose_rot_matrix(
-            cf, pose[0], pose[1], pose[2], pose[3])
+        # Set up a callback to handle data from QTM, sent on at a fixed rate
+        pose_scheduler = PoseScheduler(
+            lambda pose: send_extpose_rot_matrix(cf, pose[0], pose[1], pose[2], pose[3]),
+            rate_hz=extpose_rate_hz, mode=extpose_resample_mode)
+        qtm_wrapper.on_pose = pose_scheduler.on_pose
 
-        adjust_orientation_sensitivity(cf)
-        activate_kalman_estimator(cf)
+        apply_params(cf, orientation_sensitivity_params() + kalman_estimator_params(),
+                     label='Preflight configuration')
         # activate_mellinger_controller(cf)
         duration = upload_trajectory(cf, trajectory_id, figure8)
-        print('The sequence is {:.1f} seconds long'.format(duration))
-        reset_estimator(cf)
-        run_sequence(cf, trajectory_id, duration)
+        time_scale = feasible_time_scale(figure8, flight_limits)
+        print('The sequence is {:.1f} seconds long'.format(duration * time_scale))
+        warm_start_estimator(cf, pose_scheduler, period_in_ms=estimator_log_period_ms,
+                             window=estimator_window)
+        run_sequence(cf, trajectory_id, duration, time_scale)
+
+        pose_scheduler.close()
+        print(pose_scheduler.report())
 
     qtm_wrapper.close()
@@ -38,13 +38,17 @@ from scipy.spatial.transform import Rotation
 
 import cflib.crtp
 from cflib.crazyflie import Crazyflie
-from cflib.crazyflie.log import LogConfig
-from cflib.crazyflie.mem import MemoryElement
-from cflib.crazyflie.mem import Poly4D
 from cflib.crazyflie.syncCrazyflie import SyncCrazyflie
-from cflib.crazyflie.syncLogger import SyncLogger
 from cflib.utils import uri_helper
 
+from estimator_convergence import wait_for_convergence
+from flight_sequencer import FlightSequencer
+from mission import MissionExecutor
+from pose_scheduler import PoseScheduler
+from trajectory_analysis import TrajectoryLimits
+from trajectory_library import library_for
+from trajectory_loader import load_named_trajectory
+
 #---------------- imports for Vicon ----------------------#
 import sys
 import os
@@ -69,23 +73,37 @@ send_full_pose = True
 # degrees. If this is a problem, increase orientation_std_dev a bit. The default value in the firmware is 4.5e-3.
 orientation_std_dev = 8.0e-3
 
+# Rate at which Vicon poses are forwarded to the estimator, independent of the
+# UDP frame rate. Use PoseScheduler.INTERPOLATE to smooth irregular frames.
+extpose_rate_hz = 100
+extpose_resample_mode = PoseScheduler.HOLD
+
+# Kalman variance sampling used to detect estimator convergence. The variances
+# must stay within the threshold for estimator_window consecutive samples.
+estimator_log_period_ms = 100
+estimator_window = 10
+
+# Trajectories are time scaled as fast as these limits allow (m/s, m/s^2)
+flight_limits = TrajectoryLimits(max_velocity=1.5, max_acceleration=4.0)
+
+# The mission to fly: high level commands, trajectories referenced by their
+# name in the trajectory library. A step's 'wait' is the time until the next
+# one is issued, by default its duration; flown through the FlightSequencer,
+# steps end on the state estimate and the waits are only reported against.
+mission = [
+    {'command': 'takeoff', 'height': 1.0, 'duration': 2.0, 'wait': 1.0},
+    {'command': 'trajectory', 'name': 'figure8', 'time_scale': 'auto', 'relative': True},
+    # {'command': 'go_to', 'x': -0.0, 'y': 0.0, 'z': 0.0, 'yaw': 0.0, 'duration': 0.0},
+    {'command': 'go_to', 'x': -0.1, 'y': 0.1, 'z': 0.5, 'yaw': 0.0, 'duration': 2.0, 'wait': 3.0},
+    {'command': 'land', 'height': 0.0, 'duration': 2.0},
+]
+
 # The trajectory to fly
 # See https://github.com/whoenig/uav_trajectories for a tool to generate
 # trajectories
 
 # Duration,x^0,x^1,x^2,x^3,x^4,x^5,x^6,x^7,y^0,y^1,y^2,y^3,y^4,y^5,y^6,y^7,z^0,z^1,z^2,z^3,z^4,z^5,z^6,z^7,yaw^0,yaw^1,yaw^2,yaw^3,yaw^4,yaw^5,yaw^6,yaw^7
-figure8 = [
-    [1.050000, 0.000000, -0.000000, 0.000000, -0.000000, 0.830443, -0.276140, -0.384219, 0.180493, -0.000000, 0.000000, -0.000000, 0.000000, -1.356107, 0.688430, 0.587426, -0.329106, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000],  # noqa
-    [0.710000, 0.396058, 0.918033, 0.128965, -0.773546, 0.339704, 0.034310, -0.026417, -0.030049, -0.445604, -0.684403, 0.888433, 1.493630, -1.361618, -0.139316, 0.158875, 0.095799, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000],  # noqa
-    [0.620000, 0.922409, 0.405715, -0.582968, -0.092188, -0.114670, 0.101046, 0.075834, -0.037926, -0.291165, 0.967514, 0.421451, -1.086348, 0.545211, 0.030109, -0.050046, -0.068177, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000],  # noqa
-    [0.700000, 0.923174, -0.431533, -0.682975, 0.177173, 0.319468, -0.043852, -0.111269, 0.023166, 0.289869, 0.724722, -0.512011, -0.209623, -0.218710, 0.108797, 0.128756, -0.055461, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000],  # noqa
-    [0.560000, 0.405364, -0.834716, 0.158939, 0.288175, -0.373738, -0.054995, 0.036090, 0.078627, 0.450742, -0.385534, -0.954089, 0.128288, 0.442620, 0.055630, -0.060142, -0.076163, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000],  # noqa
-    [0.560000, 0.001062, -0.646270, -0.012560, -0.324065, 0.125327, 0.119738, 0.034567, -0.063130, 0.001593, -1.031457, 0.015159, 0.820816, -0.152665, -0.130729, -0.045679, 0.080444, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000],  # noqa
-    [0.700000, -0.402804, -0.820508, -0.132914, 0.236278, 0.235164, -0.053551, -0.088687, 0.031253, -0.449354, -0.411507, 0.902946, 0.185335, -0.239125, -0.041696, 0.016857, 0.016709, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000],  # noqa
-    [0.620000, -0.921641, -0.464596, 0.661875, 0.286582, -0.228921, -0.051987, 0.004669, 0.038463, -0.292459, 0.777682, 0.565788, -0.432472, -0.060568, -0.082048, -0.009439, 0.041158, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000],  # noqa
-    [0.710000, -0.923935, 0.447832, 0.627381, -0.259808, -0.042325, -0.032258, 0.001420, 0.005294, 0.288570, 0.873350, -0.515586, -0.730207, -0.026023, 0.288755, 0.215678, -0.148061, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000],  # noqa
-    [1.053185, -0.398611, 0.850510, -0.144007, -0.485368, -0.079781, 0.176330, 0.234482, -0.153567, 0.447039, -0.532729, -0.855023, 0.878509, 0.775168, -0.391051, -0.713519, 0.391628, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000],  # noqa
-]
+figure8 = load_named_trajectory('figure8.csv')
 
 # Define a class QtmWrapper that inherits from the Thread class. 
 # This class is responsible for connecting to the Qualisys QTM system, 
@@ -258,49 +276,8 @@ class ViconUDPDataRelay(Thread):
 # the Crazyflie's position estimator to find the position based on
 # the received data.
 def wait_for_position_estimator(scf):
-    print('Waiting for estimator to find position...')
-
-    log_config = LogConfig(name='Kalman Variance', period_in_ms=500)
-    log_config.add_variable('kalman.varPX', 'float')
-    log_config.add_variable('kalman.varPY', 'float')
-    log_config.add_variable('kalman.varPZ', 'float')
-    print("-------------------------------------------")
-    print("I am inside wait_for_position_estimator.")
-    print("-------------------------------------------")
-    var_y_history = [1000] * 10
-    var_x_history = [1000] * 10
-    var_z_history = [1000] * 10
-
-    threshold = 0.001
-
-    with SyncLogger(scf, log_config) as logger:
-        for log_entry in logger:
-            data = log_entry[1]
-            #print("-----------------------------------------------------")
-            #print("I am inside for loop of wait_for_position_estimator. ")
-            #print("-----------------------------------------------------")
-            # print(data)
-            var_x_history.append(data['kalman.varPX'])
-            var_x_history.pop(0)
-            var_y_history.append(data['kalman.varPY'])
-            var_y_history.pop(0)
-            var_z_history.append(data['kalman.varPZ'])
-            var_z_history.pop(0)
-
-            min_x = min(var_x_history)
-            max_x = max(var_x_history)
-            min_y = min(var_y_history)
-            max_y = max(var_y_history)
-            min_z = min(var_z_history)
-            max_z = max(var_z_history)
-
-            print("{} {} {}".
-                   format(max_x - min_x, max_y - min_y, max_z - min_z))
-
-            if (max_x - min_x) < threshold and (
-                    max_y - min_y) < threshold and (
-                    max_z - min_z) < threshold:
-                break
+    return wait_for_convergence(scf, period_in_ms=estimator_log_period_ms,
+                                window=estimator_window, threshold=0.001)
 
 # The _sqrt function is a helper function to ensure that a 
 # negative value is not passed to the square root function.
@@ -378,43 +355,6 @@ def activate_mellinger_controller(cf):
 #                              Send Data Finish                             #
 #---------------------------------------------------------------------------#
 
-# The upload_trajectory function uploads a trajectory to the 
-# Crazyflie, including its duration and coefficients.
-def upload_trajectory(cf, trajectory_id, trajectory):
-    trajectory_mem = cf.mem.get_mems(MemoryElement.TYPE_TRAJ)[0]
-    trajectory_mem.trajectory = []
-
-    total_duration = 0
-    for row in trajectory:
-        duration = row[0]
-        x = Poly4D.Poly(row[1:9])
-        y = Poly4D.Poly(row[9:17])
-        z = Poly4D.Poly(row[17:25])
-        yaw = Poly4D.Poly(row[25:33])
-        trajectory_mem.trajectory.append(Poly4D(duration, x, y, z, yaw))
-        total_duration += duration
-
-    trajectory_mem.write_data_sync()
-    cf.high_level_commander.define_trajectory(trajectory_id, 0, len(trajectory_mem.trajectory))
-    return total_duration
-
-# The run_sequence function executes the uploaded 
-# trajectory using the high-level commander.
-def run_sequence(cf, trajectory_id, duration):
-    commander = cf.high_level_commander
-
-    commander.takeoff(1.0, 2.0)
-    time.sleep(1.0)
-    relative = True
-    commander.start_trajectory(trajectory_id, 1.0, relative)
-    time.sleep(duration)
-    #commander.go_to(-0.0, 0.0, 0.0, 0.0, 0.0)
-    commander.go_to(-0.1, 0.1, 0.5, 0.0, 2.0)
-    time.sleep(3.0)
-    commander.land(0.0, 2.0)
-    time.sleep(2)
-    commander.stop()
-
 def handle_pose(pose):
     send_extpose_rot_matrix(cf, pose[0], pose[1], pose[2], pose[3])
 # The main part of the code initiates Crazyflie drivers, 
@@ -422,7 +362,7 @@ def handle_pose(pose):
 # sets up a callback to handle pose data, 
 # adjusts the estimator's settings, 
 # uploads the trajectory, resets the estimator, and 
-# finally runs the trajectory sequence.
+# finally flies the mission.
 
 if __name__ == "__main__":
 
@@ -445,8 +385,12 @@ if __name__ == "__main__":
     pose = [0,0,0,np.zeros((3,3))]
     with SyncCrazyflie(uri, cf=Crazyflie(rw_cache='./cache')) as scf:
         cf = scf.cf
-        trajectory_id = 1
         commander = cf.high_level_commander
+        library = library_for(cf)
+        library.add('figure8', figure8)
+        mission_executor = MissionExecutor(cf, library, limits=flight_limits)
+        pose_scheduler = PoseScheduler(handle_pose, rate_hz=extpose_rate_hz,
+                                       mode=extpose_resample_mode)
         time.sleep(2)
         commander.stop()
         # reading Vicon Data
@@ -491,7 +435,7 @@ if __name__ == "__main__":
 
                 #my_vicon_data_relay.on_pose = lambda pose: send_extpose_rot_matrix(
                 # cf, pose[0], pose[1], pose[2], pose[3])
-                my_vicon_data_relay.on_pose = handle_pose
+                my_vicon_data_relay.on_pose = pose_scheduler.on_pose
                 print("------------------------------------------------------")
                 print(my_vicon_data_relay.on_pose)
                 print("------------------------------------------------------")
@@ -503,14 +447,17 @@ if __name__ == "__main__":
                 print("------------------------------------")
                 activate_kalman_estimator(cf)
                 time.sleep(10)
-                duration = upload_trajectory(cf, trajectory_id, figure8)
-                print('The sequence is {:.1f} seconds long'.format(duration))
+                # Trajectories are uploaded and the timeline computed before takeoff
+                timeline = mission_executor.plan(mission)
+                mission_executor.prefetch(mission)
+                print('The mission is {:.1f} seconds long'.format(timeline[-1].offset))
                 reset_estimator(cf)
                 time.sleep(5)
                 print("------------------------------------")
                 print("         Estimator reset            ")
                 print("------------------------------------")
-                run_sequence(cf, trajectory_id, duration)
+                # Each step ends when the state estimate says it is done, not after its wait
+                mission_executor.run(mission, timeline, sequencer=FlightSequencer(cf))
                 
             except(KeyboardInterrupt,SystemExit):
                 print("\nClosing program ...")
@@ -518,6 +465,8 @@ if __name__ == "__main__":
                 time.sleep(0.1)
                 commander.stop()
                 time.sleep(0.1)
+                pose_scheduler.close()
+                print(pose_scheduler.report())
                 # Close socket
                 RX_sock.close()
                 # Exit program1
@@ -0,0 +1,119 @@
+"""
+Host-side trajectory execution through the low level commander.
+
+The high level commander can only fly what fits in trajectory memory. Here
+the Poly4D table is evaluated on the host instead, and position, velocity
+and acceleration setpoints are streamed with send_full_state_setpoint at a
+fixed rate, so a path can be arbitrarily long or generated on the fly.
+
+Segments are found by bisecting the segment start times and evaluated with
+Horner's scheme. Setpoints go out on the same monotonic deadline grid as
+the extpose stream (DeadlineTicker), and the lateness histogram reports the
+setpoint jitter.
+
+    path = PiecewisePolynomial(trajectory)
+    streamer = SetpointStreamer(cf, path, rate_hz=100)
+    streamer.run(origin=(x, y, z))      # blocks until the path is flown
+    print(streamer.report())
+
+Any object with a duration attribute and a sample(t) method returning
+(position, velocity, acceleration, yaw) can be streamed the same way.
+"""
+import bisect
+import math
+import time
+
+from pose_scheduler import DeadlineTicker
+
+
+def _horner(coefficients, t):
+    value = 0.0
+    for coefficient in reversed(coefficients):
+        value = value * t + coefficient
+    return value
+
+
+def _derivative(coefficients):
+    return [k * coefficients[k] for k in range(1, len(coefficients))]
+
+
+class PiecewisePolynomial:
+    """Host-side evaluation of an (N, 33) Poly4D table."""
+
+    def __init__(self, trajectory):
+        self.starts = []
+        self.segments = []
+        start = 0.0
+        for row in trajectory:
+            row = [float(value) for value in row]
+            axes = [row[1 + 8 * axis:9 + 8 * axis] for axis in range(4)]
+            velocity = [_derivative(axis) for axis in axes[:3]]
+            acceleration = [_derivative(axis) for axis in velocity]
+            self.starts.append(start)
+            self.segments.append((row[0], axes, velocity, acceleration))
+            start += row[0]
+        self.duration = start
+
+    def segment_at(self, t):
+        """Index of the segment flown at time t, clamped to the table."""
+        return min(max(bisect.bisect_right(self.starts, t) - 1, 0), len(self.segments) - 1)
+
+    def sample(self, t):
+        """(position, velocity, acceleration, yaw) at time t from the start of the table."""
+        index = self.segment_at(t)
+        duration, axes, velocity, acceleration = self.segments[index]
+        local = min(max(t - self.starts[index], 0.0), duration)
+        return ([_horner(axis, local) for axis in axes[:3]],
+                [_horner(axis, local) for axis in velocity],
+                [_horner(axis, local) for axis in acceleration],
+                _horner(axes[3], local))
+
+
+class SetpointStreamer:
+    def __init__(self, cf, path, rate_hz=100, time_scale=1.0):
+        self.cf = cf
+        self.path = path
+        self.rate_hz = rate_hz
+        # As in start_trajectory: 2.0 flies the path at half speed
+        self.time_scale = time_scale
+        self.duration = path.duration * time_scale
+        self.ticker = DeadlineTicker(rate_hz)
+        self.setpoints = 0
+
+    def _send(self, t, offset):
+        position, velocity, acceleration, yaw = self.path.sample(t / self.time_scale)
+        position = [p + o for p, o in zip(position, offset)]
+        velocity = [v / self.time_scale for v in velocity]
+        acceleration = [a / self.time_scale ** 2 for a in acceleration]
+        orientation = [0.0, 0.0, math.sin(yaw / 2.0), math.cos(yaw / 2.0)]
+        self.cf.commander.send_full_state_setpoint(position, velocity, acceleration, orientation, 0.0, 0.0, 0.0)
+        self.setpoints += 1
+
+    def run(self, origin=None):
+        """
+        Stream the whole path, then hand control back to the high level
+        commander. With origin the path is flown relative to it, like a
+        relative start_trajectory: its start point is moved to origin.
+        """
+        offset = (0.0, 0.0, 0.0)
+        if origin is not None:
+            offset = [o - s for o, s in zip(origin, self.path.sample(0.0)[0])]
+
+        self.ticker.histogram.reset()
+        start = time.monotonic()
+        self.ticker.start(start)
+        try:
+            while True:
+                deadline = self.ticker.wait()
+                t = deadline - start
+                if t > self.duration:
+                    break
+                self._send(t, offset)
+            # Make sure the final setpoint is the end of the path
+            self._send(self.duration, offset)
+        finally:
+            self.cf.commander.send_notify_setpoint_stop()
+
+    def report(self):
+        return 'Setpoint stream: {} setpoints at {} Hz over {:.1f} s, {}'.format(
+            self.setpoints, self.rate_hz, self.duration, self.ticker.histogram.report())
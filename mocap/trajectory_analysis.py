@@ -0,0 +1,203 @@
+"""
+Batched evaluation and feasibility checks for Poly4D trajectory tables.
+
+All segments are evaluated at once: each one is sampled on its own dense grid
+of local times, and position, velocity, acceleration and jerk of every axis
+come out of a single einsum against the derivative coefficient tables. The
+resulting report gives the bounding box, the peak velocity, acceleration and
+jerk magnitudes, and how far neighbouring segments disagree at their joins.
+
+    report = analyze(trajectory)
+    print(report)
+    problems = report.problems(TrajectoryLimits(max_velocity=1.0))
+"""
+import numpy as np
+
+from trajectory_loader import validate_trajectory
+
+DERIVATIVE_NAMES = ('position', 'velocity', 'acceleration', 'jerk')
+
+
+def _derivative_tables(degree=7, orders=4):
+    """
+    (orders, degree + 1, degree + 1) matrices D such that coefficients @ D[d]
+    are the power basis coefficients of the d-th derivative.
+    """
+    tables = np.zeros((orders, degree + 1, degree + 1))
+    for order in range(orders):
+        for k in range(order, degree + 1):
+            factor = 1.0
+            for j in range(order):
+                factor *= k - j
+            tables[order, k, k - order] = factor
+    return tables
+
+
+_DERIVATIVES = _derivative_tables()
+
+
+def evaluate(trajectory, samples_per_segment=100):
+    """
+    Sample every segment at samples_per_segment evenly spaced local times,
+    end points included. Returns (times, values) where times is (N, K) in
+    seconds from the start of the trajectory and values is (4, N, K, 4):
+    derivative order, segment, sample, axis (x, y, z, yaw).
+    """
+    trajectory = validate_trajectory(np.asarray(trajectory, dtype=np.float64))
+    durations = trajectory[:, 0]
+    coefficients = trajectory[:, 1:33].reshape(-1, 4, 8)
+
+    local = durations[:, None] * np.linspace(0.0, 1.0, samples_per_segment)[None, :]
+    powers = local[:, :, None] ** np.arange(8)[None, None, :]
+    derivative_coefficients = np.einsum('nak,dkj->dnaj', coefficients, _DERIVATIVES)
+    values = np.einsum('dnaj,ntj->dnta', derivative_coefficients, powers)
+
+    starts = np.concatenate(([0.0], np.cumsum(durations)[:-1]))
+    return starts[:, None] + local, values
+
+
+class TrajectoryLimits:
+    """
+    Limits a trajectory must respect. Magnitudes are over x, y and z; None
+    disables a check. bounds is ((min_x, min_y, min_z), (max_x, max_y, max_z))
+    in the trajectory's own frame.
+    """
+
+    def __init__(self, max_velocity=2.0, max_acceleration=10.0, max_jerk=None,
+                 max_discontinuity=(0.01, 0.1, 1.0), bounds=None):
+        self.max_velocity = max_velocity
+        self.max_acceleration = max_acceleration
+        self.max_jerk = max_jerk
+        # Allowed jump at segment joins in position, velocity and acceleration
+        self.max_discontinuity = max_discontinuity
+        self.bounds = bounds
+
+
+DEFAULT_LIMITS = TrajectoryLimits()
+
+# Fastest time scale feasible_time_scale picks, ten times the trajectory's own speed
+MIN_TIME_SCALE = 0.1
+
+# Relative slack on the limits, so the time scale time_scale() returns passes check_feasible
+LIMIT_TOLERANCE = 1e-9
+
+
+class TrajectoryReport:
+    def __init__(self, trajectory, samples_per_segment=100):
+        self.times, values = evaluate(trajectory, samples_per_segment)
+        self.duration = float(self.times[-1, -1])
+        self.segments = values.shape[1]
+
+        positions = values[0, :, :, :3].reshape(-1, 3)
+        self.bounding_box = (positions.min(axis=0), positions.max(axis=0))
+
+        # Peak magnitude of velocity, acceleration and jerk, and when it happens
+        self.peaks = {}
+        for order in (1, 2, 3):
+            magnitude = np.linalg.norm(values[order, :, :, :3], axis=-1)
+            index = np.unravel_index(np.argmax(magnitude), magnitude.shape)
+            self.peaks[DERIVATIVE_NAMES[order]] = (float(magnitude[index]), float(self.times[index]))
+
+        # Largest jump at any join, per derivative order, and the join it is at
+        self.join_errors = {}
+        for order in (0, 1, 2):
+            if self.segments < 2:
+                self.join_errors[DERIVATIVE_NAMES[order]] = (0.0, None)
+                continue
+            jumps = np.linalg.norm(values[order, 1:, 0, :3] - values[order, :-1, -1, :3], axis=-1)
+            join = int(np.argmax(jumps))
+            self.join_errors[DERIVATIVE_NAMES[order]] = (float(jumps[join]), join + 1)
+
+    def peak(self, name):
+        return self.peaks[name][0]
+
+    def time_scale(self, limits=DEFAULT_LIMITS, min_scale=MIN_TIME_SCALE):
+        """
+        Smallest start_trajectory time scale that keeps velocity, acceleration
+        and jerk within limits. Flying at time scale s stretches the trajectory
+        to s times its duration, dividing the k-th derivative by s^k, so each
+        limit needs s >= (peak / limit)^(1/k). The scale is never below
+        min_scale. A hover, which no limit constrains, keeps its own timing.
+        """
+        if min_scale <= 0.0:
+            raise ValueError('min_scale must be positive, not {}'.format(min_scale))
+        scale = 0.0
+        for order, limit in ((1, limits.max_velocity), (2, limits.max_acceleration), (3, limits.max_jerk)):
+            if limit is not None:
+                scale = max(scale, (self.peak(DERIVATIVE_NAMES[order]) / limit) ** (1.0 / order))
+        if scale == 0.0:
+            return 1.0
+        return max(scale, min_scale)
+
+    def problems(self, limits=DEFAULT_LIMITS, time_scale=1.0):
+        """
+        Descriptions of every limit the trajectory violates when flown at
+        time_scale, empty if feasible. The k-th derivative is divided by
+        time_scale^k, as in time_scale().
+        """
+        problems = []
+        for order, name, limit in ((1, 'velocity', limits.max_velocity),
+                                   (2, 'acceleration', limits.max_acceleration),
+                                   (3, 'jerk', limits.max_jerk)):
+            value, at = self.peaks[name]
+            value /= time_scale ** order
+            if limit is not None and value > limit * (1.0 + LIMIT_TOLERANCE):
+                problems.append('peak {} {:.2f} exceeds {:.2f} at t = {:.2f} s'.format(
+                    name, value, limit, at * time_scale))
+
+        if limits.max_discontinuity is not None:
+            for order, (name, limit) in enumerate(zip(DERIVATIVE_NAMES, limits.max_discontinuity)):
+                value, join = self.join_errors[name]
+                value /= time_scale ** order
+                if limit is not None and value > limit:
+                    problems.append('{} jumps by {:.3f} entering segment {}'.format(name, value, join))
+
+        if limits.bounds is not None:
+            low, high = (np.asarray(bound, dtype=np.float64) for bound in limits.bounds)
+            if np.any(self.bounding_box[0] < low) or np.any(self.bounding_box[1] > high):
+                problems.append('bounding box {} .. {} leaves {} .. {}'.format(
+                    np.round(self.bounding_box[0], 3), np.round(self.bounding_box[1], 3), low, high))
+
+        return problems
+
+    def __str__(self):
+        low, high = self.bounding_box
+        return ('{} segments, {:.2f} s, box x {:.2f}..{:.2f} y {:.2f}..{:.2f} z {:.2f}..{:.2f} m, '
+                'peak v {:.2f} m/s a {:.2f} m/s^2 j {:.2f} m/s^3, '
+                'max join error p {:.4f} m v {:.4f} m/s a {:.4f} m/s^2').format(
+            self.segments, self.duration, low[0], high[0], low[1], high[1], low[2], high[2],
+            self.peak('velocity'), self.peak('acceleration'), self.peak('jerk'),
+            self.join_errors['position'][0], self.join_errors['velocity'][0],
+            self.join_errors['acceleration'][0])
+
+
+def analyze(trajectory, samples_per_segment=100):
+    return TrajectoryReport(trajectory, samples_per_segment)
+
+
+def check_feasible(trajectory, limits=DEFAULT_LIMITS, label='Trajectory', time_scale=1.0):
+    """
+    Analyze trajectory and raise ValueError listing the violations if it is
+    not feasible under limits when flown at time_scale. Returns the report
+    otherwise.
+    """
+    report = analyze(trajectory)
+    print('{}: {}'.format(label, report))
+    problems = report.problems(limits, time_scale)
+    if problems:
+        raise ValueError('{} is infeasible at time scale {:.2f}: {}'.format(label, time_scale, '; '.join(problems)))
+    return report
+
+
+def feasible_time_scale(trajectory, limits=DEFAULT_LIMITS, min_scale=MIN_TIME_SCALE, label='Trajectory'):
+    """
+    The smallest time scale at which trajectory stays within limits, to pass
+    to start_trajectory, and at least min_scale (see
+    TrajectoryReport.time_scale). The flight then takes duration * time scale.
+    """
+    report = analyze(trajectory)
+    scale = report.time_scale(limits, min_scale)
+    print('{}: time scale {:.2f} (peak v {:.2f} m/s, a {:.2f} m/s^2 at that scale), flies {:.1f} s'.format(
+        label, scale, report.peak('velocity') / scale, report.peak('acceleration') / scale ** 2,
+        report.duration * scale))
+    return scale
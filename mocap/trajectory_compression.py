@@ -0,0 +1,166 @@
+"""
+Encoder for the firmware's compressed trajectory format.
+
+A Poly4D record is 132 bytes whatever the segment looks like. The compressed
+format (TRAJECTORY_TYPE_POLY4D_COMPRESSED) stores each axis of a segment as
+Bezier control points quantized to int16, and only as many of them as the
+polynomial needs:
+
+    start:    x, y, z (mm), yaw (0.1 deg)              4 x int16
+    segment:  axis types (2 bits per axis: x, y, z, yaw)   uint8
+              duration (ms)                                uint16
+              control points for x, y, z, then yaw         int16 each
+
+Axis types are 0 (constant, no points), 1 (linear, 1 point), 2 (cubic, 3
+points) and 3 (7th degree, 7 points). The first control point of every
+segment is implicit, it is the last control point of the previous segment.
+So the table must be continuous in position, which fidelity() verifies by
+decoding the image again and comparing it with the original polynomials.
+"""
+import math
+import struct
+from math import comb
+
+import numpy as np
+
+START_FORMAT = struct.Struct('<4h')
+SEGMENT_HEADER = struct.Struct('<BH')
+
+SPATIAL_SCALE = 1000.0                # metres -> mm
+YAW_SCALE = 10.0 * 180.0 / math.pi    # radians -> 0.1 degree
+
+# Bezier degree for each axis type, and the type for each degree
+TYPE_DEGREES = (0, 1, 3, 7)
+
+
+def _bezier_matrix(degree):
+    """Maps power basis coefficients on s in [0, 1] to Bezier control points."""
+    matrix = np.zeros((degree + 1, degree + 1))
+    for i in range(degree + 1):
+        for k in range(i + 1):
+            matrix[i, k] = comb(i, k) / comb(degree, k)
+    return matrix
+
+
+_BEZIER_MATRICES = {degree: _bezier_matrix(degree) for degree in TYPE_DEGREES}
+
+
+def _normalized_coefficients(trajectory):
+    """
+    (N, 4, 8) power basis coefficients in normalized time s = t / duration,
+    for the x, y, z and yaw axes.
+    """
+    trajectory = np.asarray(trajectory, dtype=np.float64)
+    durations = trajectory[:, 0]
+    coefficients = trajectory[:, 1:33].reshape(-1, 4, 8)
+    powers = durations[:, None] ** np.arange(8)[None, :]
+    return coefficients * powers[:, None, :]
+
+
+def _lowest_degree(coefficients, tolerance):
+    """
+    Smallest supported degree whose truncation stays within tolerance.
+    On s in [0, 1] the truncation error is bounded by the sum of the dropped
+    coefficients' magnitudes.
+    """
+    for degree in TYPE_DEGREES[:-1]:
+        if np.sum(np.abs(coefficients[degree + 1:])) < tolerance:
+            return degree
+    return 7
+
+
+def encode_compressed(trajectory, tolerance_m=0.0005, tolerance_yaw=math.radians(0.05)):
+    """
+    Encode (N, 33) uav_trajectories rows into the compressed memory image.
+    Returns (data, n_pieces).
+    """
+    normalized = _normalized_coefficients(trajectory)
+    scales = (SPATIAL_SCALE, SPATIAL_SCALE, SPATIAL_SCALE, YAW_SCALE)
+    tolerances = (tolerance_m, tolerance_m, tolerance_m, tolerance_yaw)
+
+    def _quantize(values, scale):
+        quantized = np.rint(np.asarray(values) * scale)
+        if np.any(np.abs(quantized) > 32767):
+            raise ValueError('Trajectory exceeds the int16 range of the compressed format')
+        return quantized.astype(int)
+
+    start = [_quantize(normalized[0, axis, 0], scales[axis]) for axis in range(4)]
+    data = bytearray(START_FORMAT.pack(*start))
+
+    for segment, duration in zip(normalized, np.asarray(trajectory)[:, 0]):
+        duration_ms = int(round(duration * 1000.0))
+        if not 0 < duration_ms <= 0xffff:
+            raise ValueError('Segment duration {} s does not fit the compressed format'.format(duration))
+
+        types = 0
+        points = []
+        for axis in range(4):
+            degree = _lowest_degree(segment[axis], tolerances[axis])
+            types |= TYPE_DEGREES.index(degree) << (2 * axis)
+            if degree > 0:
+                control = _BEZIER_MATRICES[degree] @ segment[axis, :degree + 1]
+                points.extend(_quantize(control[1:], scales[axis]))
+
+        data += SEGMENT_HEADER.pack(types, duration_ms)
+        data += struct.pack('<{}h'.format(len(points)), *points)
+
+    return bytes(data), len(normalized)
+
+
+def decode_compressed(data, n_pieces):
+    """
+    Decode a compressed image into (durations, control points) where control
+    points is a list of per-segment lists of four arrays (x, y, z, yaw) in
+    metres and radians, first point included.
+    """
+    scales = (SPATIAL_SCALE, SPATIAL_SCALE, SPATIAL_SCALE, YAW_SCALE)
+    previous = [value / scale for value, scale in zip(START_FORMAT.unpack_from(data, 0), scales)]
+    offset = START_FORMAT.size
+
+    durations = []
+    segments = []
+    for _ in range(n_pieces):
+        types, duration_ms = SEGMENT_HEADER.unpack_from(data, offset)
+        offset += SEGMENT_HEADER.size
+        axes = []
+        for axis in range(4):
+            degree = TYPE_DEGREES[(types >> (2 * axis)) & 0x3]
+            stored = struct.unpack_from('<{}h'.format(degree), data, offset)
+            offset += 2 * degree
+            axes.append(np.array([previous[axis]] + [value / scales[axis] for value in stored]))
+            previous[axis] = axes[-1][-1]
+        durations.append(duration_ms / 1000.0)
+        segments.append(axes)
+
+    return durations, segments
+
+
+def _bernstein(points, s):
+    degree = len(points) - 1
+    if degree == 0:
+        return np.full_like(s, points[0])
+    basis = np.array([comb(degree, i) * s ** i * (1.0 - s) ** (degree - i) for i in range(degree + 1)])
+    return points @ basis
+
+
+def fidelity(trajectory, data, n_pieces, samples_per_segment=50):
+    """
+    Maximum deviation between the original polynomials and the decoded
+    compressed image, as (position in metres, yaw in radians), sampled at the
+    same normalized times in every segment.
+    """
+    normalized = _normalized_coefficients(trajectory)
+    _, segments = decode_compressed(data, n_pieces)
+
+    s = np.linspace(0.0, 1.0, samples_per_segment)
+    powers = s[None, :] ** np.arange(8)[:, None]
+    max_position = 0.0
+    max_yaw = 0.0
+    for original, decoded in zip(normalized, segments):
+        reference = original @ powers
+        values = np.array([_bernstein(points, s) for points in decoded])
+        position_error = np.linalg.norm(values[:3] - reference[:3], axis=0)
+        max_position = max(max_position, float(np.max(position_error)))
+        max_yaw = max(max_yaw, float(np.max(np.abs(values[3] - reference[3]))))
+
+    return max_position, max_yaw
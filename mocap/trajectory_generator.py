@@ -0,0 +1,162 @@
+"""
+Minimum snap trajectories from waypoints, in process.
+
+Produces the same 33-column Poly4D tables as the uav_trajectories tool, so
+they can go straight to upload_trajectory:
+
+    waypoints = [(0, 0, 0), (1, 0, 0.5), (1, 1, 0.5), (0, 1, 0)]
+    trajectory = min_snap(waypoints, allocate_durations(waypoints, mean_speed=0.5))
+
+Each axis is a 7th degree polynomial per segment that passes through the
+waypoints and starts and ends at rest (zero velocity, acceleration and jerk).
+With the interior derivatives left free, the snap-minimizing polynomials are
+the ones continuous up to the 6th derivative at every waypoint, which makes
+the problem a square linear system. The system only depends on the
+durations, so all four axes are solved with one factorization.
+
+Results are cached by a hash of the waypoints and durations, so
+regenerating a trajectory within a session costs nothing.
+
+Run as a script to time a 30 segment solve.
+"""
+import hashlib
+import time
+from math import factorial
+
+import numpy as np
+from scipy.linalg import lu_factor
+from scipy.linalg import lu_solve
+
+DEGREE = 7
+COEFFICIENTS = DEGREE + 1
+
+# Derivatives held at zero at both ends, and kept continuous at the waypoints
+END_DERIVATIVES = (1, 2, 3)
+CONTINUOUS_DERIVATIVES = (1, 2, 3, 4, 5, 6)
+
+# sha1 of the inputs -> (N, 33) read-only array
+_cache = {}
+_CACHE_SIZE = 64
+
+
+def _derivative_row(order, s):
+    """Coefficients of the order-th derivative at normalized time s, for a 7th degree polynomial."""
+    row = np.zeros(COEFFICIENTS)
+    for k in range(order, COEFFICIENTS):
+        row[k] = factorial(k) / factorial(k - order) * s ** (k - order)
+    return row
+
+
+def _constraint_matrix(durations):
+    """
+    Square constraint matrix over the normalized coefficients of all
+    segments. Segment i is p_i(s) with s = t / T_i, so its d-th time
+    derivative is p_i^(d)(s) / T_i^d.
+    """
+    segments = len(durations)
+    size = COEFFICIENTS * segments
+    matrix = np.zeros((size, size))
+    row = 0
+
+    for i in range(segments):
+        columns = slice(COEFFICIENTS * i, COEFFICIENTS * (i + 1))
+        # Passes through the waypoints at both ends
+        matrix[row, columns] = _derivative_row(0, 0.0)
+        matrix[row + 1, columns] = _derivative_row(0, 1.0)
+        row += 2
+
+    for order in END_DERIVATIVES:
+        matrix[row, 0:COEFFICIENTS] = _derivative_row(order, 0.0)
+        matrix[row + 1, size - COEFFICIENTS:] = _derivative_row(order, 1.0)
+        row += 2
+
+    for i in range(segments - 1):
+        left = slice(COEFFICIENTS * i, COEFFICIENTS * (i + 1))
+        right = slice(COEFFICIENTS * (i + 1), COEFFICIENTS * (i + 2))
+        for order in CONTINUOUS_DERIVATIVES:
+            matrix[row, left] = _derivative_row(order, 1.0) / durations[i] ** order
+            matrix[row, right] = -_derivative_row(order, 0.0) / durations[i + 1] ** order
+            row += 1
+
+    return matrix
+
+
+def allocate_durations(waypoints, mean_speed=0.5, min_duration=0.5):
+    """Segment durations proportional to the straight-line distance between waypoints."""
+    positions = np.asarray(waypoints, dtype=np.float64)[:, :3]
+    distances = np.linalg.norm(np.diff(positions, axis=0), axis=1)
+    return np.maximum(distances / mean_speed, min_duration)
+
+
+def _key(waypoints, durations):
+    digest = hashlib.sha1()
+    digest.update(np.ascontiguousarray(waypoints).tobytes())
+    digest.update(np.ascontiguousarray(durations).tobytes())
+    return digest.hexdigest()
+
+
+def min_snap(waypoints, durations):
+    """
+    Minimum snap trajectory through waypoints, rows of (x, y, z) or
+    (x, y, z, yaw) with yaw in radians, with durations[i] seconds between
+    waypoint i and i + 1. Returns an (N, 33) table in uav_trajectories
+    column order; the array is shared with the cache and read-only.
+    """
+    waypoints = np.asarray(waypoints, dtype=np.float64)
+    durations = np.asarray(durations, dtype=np.float64).reshape(-1)
+    if waypoints.ndim != 2 or waypoints.shape[1] not in (3, 4):
+        raise ValueError('Waypoints must be rows of (x, y, z) or (x, y, z, yaw), got shape {}'.format(
+            waypoints.shape))
+    if waypoints.shape[1] == 3:
+        waypoints = np.hstack((waypoints, np.zeros((len(waypoints), 1))))
+    if len(waypoints) < 2 or len(durations) != len(waypoints) - 1:
+        raise ValueError('Need at least two waypoints and one duration per segment, got {} and {}'.format(
+            len(waypoints), len(durations)))
+    if not np.all(durations > 0):
+        raise ValueError('Segment durations must be positive')
+
+    key = _key(waypoints, durations)
+    if key in _cache:
+        return _cache[key]
+
+    segments = len(durations)
+    rhs = np.zeros((COEFFICIENTS * segments, 4))
+    rhs[0:2 * segments:2] = waypoints[:-1]
+    rhs[1:2 * segments:2] = waypoints[1:]
+
+    normalized = lu_solve(lu_factor(_constraint_matrix(durations)), rhs)
+
+    # Back from normalized time: a_k = b_k / T^k
+    normalized = normalized.reshape(segments, COEFFICIENTS, 4)
+    scale = durations[:, None] ** -np.arange(COEFFICIENTS)[None, :]
+    coefficients = normalized * scale[:, :, None]
+
+    trajectory = np.empty((segments, 33))
+    trajectory[:, 0] = durations
+    trajectory[:, 1:] = coefficients.transpose(0, 2, 1).reshape(segments, 32)
+    trajectory.setflags(write=False)
+
+    if len(_cache) >= _CACHE_SIZE:
+        del _cache[next(iter(_cache))]
+    _cache[key] = trajectory
+    return trajectory
+
+
+if __name__ == '__main__':
+    from trajectory_analysis import analyze
+
+    rng = np.random.default_rng(1)
+    waypoints = np.cumsum(rng.uniform(-0.5, 0.5, (31, 3)), axis=0)
+    durations = allocate_durations(waypoints)
+
+    start = time.perf_counter()
+    trajectory = min_snap(waypoints, durations)
+    solve_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    min_snap(waypoints, durations)
+    cached_time = time.perf_counter() - start
+
+    print('{} segments solved in {:.2f} ms, cached in {:.3f} ms'.format(
+        len(trajectory), solve_time * 1000.0, cached_time * 1000.0))
+    print(analyze(trajectory))
@@ -0,0 +1,225 @@
+"""
+On-drone trajectory library.
+
+Instead of re-uploading whichever trajectory is commented in at offset 0,
+register every trajectory of a session by name once. Each name gets its own
+trajectory id and its own place in trajectory memory, handed out from a
+free list, so several trajectories are resident at the same time and
+switching between them only costs a define_trajectory:
+
+    library = library_for(cf)
+    library.add('figure8', figure8)
+    library.add('my_trajectory', my_trajectory, compressed=True)
+    trajectory_id, duration = library.select('figure8')
+
+What is resident is remembered per drone (by link URI) across reconnects.
+After a reconnect each entry is checked by reading its first record back
+before it is trusted, since the Crazyflie may have rebooted in between. When
+memory runs out the least recently selected entries are evicted.
+
+The library assumes it owns the trajectory memory; do not mix it with
+DoubleBufferedTrajectories on the same drone.
+"""
+import hashlib
+import itertools
+
+from trajectory_analysis import DEFAULT_LIMITS
+from trajectory_memory import POLY4D_SIZE
+from trajectory_memory import encode_trajectory
+from trajectory_memory import read_memory_sync
+from trajectory_memory import trajectory_duration
+from trajectory_memory import trajectory_mem_of
+from trajectory_memory import write_image
+
+# The firmware holds this many trajectory definitions (ids 0 to 9)
+MAX_TRAJECTORY_IDS = 10
+
+# Offsets are kept word aligned for the firmware's float reads
+ALIGNMENT = 4
+
+
+class FreeList:
+    """First-fit allocator over [0, size), merging neighbouring free extents."""
+
+    def __init__(self, size):
+        self.size = size
+        # Sorted, non-adjacent (offset, length) extents
+        self.extents = [(0, size)]
+
+    def allocate(self, length):
+        """Offset of a free block of length bytes, or None if none is large enough."""
+        length = -(-length // ALIGNMENT) * ALIGNMENT
+        for index, (offset, free) in enumerate(self.extents):
+            if free >= length:
+                if free == length:
+                    del self.extents[index]
+                else:
+                    self.extents[index] = (offset + length, free - length)
+                return offset
+        return None
+
+    def release(self, offset, length):
+        length = -(-length // ALIGNMENT) * ALIGNMENT
+        self.extents.append((offset, length))
+        self.extents.sort()
+        merged = []
+        for start, free in self.extents:
+            if merged and merged[-1][0] + merged[-1][1] == start:
+                merged[-1] = (merged[-1][0], merged[-1][1] + free)
+            else:
+                merged.append((start, free))
+        self.extents = merged
+
+    def free_bytes(self):
+        return sum(free for _, free in self.extents)
+
+
+class LibraryEntry:
+    def __init__(self, name, trajectory_id, trajectory, data, n_pieces, trajectory_type):
+        self.name = name
+        self.trajectory_id = trajectory_id
+        self.trajectory = trajectory
+        self.data = data
+        self.n_pieces = n_pieces
+        self.trajectory_type = trajectory_type
+        self.duration = trajectory_duration(trajectory)
+        self.digest = hashlib.sha1(data).hexdigest()
+        # Where the entry lives in trajectory memory, None when not allocated
+        self.offset = None
+        # True if the drone is known to hold data at offset, None if unknown (after a reconnect)
+        self.resident = False
+        self.last_used = 0
+
+
+class TrajectoryLibrary:
+    def __init__(self, cf, trajectory_ids=range(1, MAX_TRAJECTORY_IDS)):
+        self.cf = None
+        self.free_ids = list(trajectory_ids)
+        self.entries = {}
+        self.free_list = None
+        self.uploads = 0
+        self.switches = 0
+        self._clock = itertools.count(1)
+        self.bind(cf)
+
+    def bind(self, cf):
+        """Use this library with a (re)connected Crazyflie object."""
+        if self.free_list is None:
+            self.free_list = FreeList(trajectory_mem_of(cf).size)
+        if cf is not self.cf:
+            cf.disconnected.add_callback(self._disconnected)
+            self.cf = cf
+
+    def _disconnected(self, link_uri):
+        for entry in self.entries.values():
+            if entry.resident:
+                entry.resident = None
+
+    def add(self, name, trajectory, compressed=False, limits=DEFAULT_LIMITS, time_scale=1.0):
+        """
+        Register trajectory under name, replacing a different trajectory of
+        the same name. Nothing is uploaded until the entry is loaded or
+        selected. limits are checked at time_scale, the smallest (fastest)
+        time scale the entry will be flown at. Returns the trajectory id of
+        the name.
+        """
+        data, n_pieces, trajectory_type = encode_trajectory(
+            trajectory, compressed, limits=limits, label='Trajectory {}'.format(name), time_scale=time_scale)
+
+        existing = self.entries.get(name)
+        if existing is not None:
+            if existing.digest == hashlib.sha1(data).hexdigest():
+                return existing.trajectory_id
+            self._evict(existing)
+            trajectory_id = existing.trajectory_id
+        elif self.free_ids:
+            trajectory_id = self.free_ids.pop(0)
+        else:
+            raise ValueError('No free trajectory id for {}'.format(name))
+
+        if len(data) > self.free_list.size:
+            raise ValueError('Trajectory {} ({} bytes) is larger than trajectory memory'.format(name, len(data)))
+        self.entries[name] = LibraryEntry(name, trajectory_id, trajectory, data, n_pieces, trajectory_type)
+        return trajectory_id
+
+    def remove(self, name):
+        entry = self.entries.pop(name)
+        self._evict(entry)
+        self.free_ids.append(entry.trajectory_id)
+
+    def _evict(self, entry):
+        if entry.offset is not None:
+            self.free_list.release(entry.offset, len(entry.data))
+            print('Trajectory library: evicted {} from offset {}'.format(entry.name, entry.offset))
+            entry.offset = None
+            entry.resident = False
+
+    def _allocate(self, entry):
+        offset = self.free_list.allocate(len(entry.data))
+        while offset is None:
+            candidates = [other for other in self.entries.values()
+                          if other is not entry and other.offset is not None]
+            if not candidates:
+                raise ValueError('Trajectory {} ({} bytes) does not fit in trajectory memory'.format(
+                    entry.name, len(entry.data)))
+            self._evict(min(candidates, key=lambda other: other.last_used))
+            offset = self.free_list.allocate(len(entry.data))
+        entry.offset = offset
+
+    def _still_resident(self, entry):
+        """Compare the first record on the drone with what was uploaded."""
+        sample = entry.data[:POLY4D_SIZE]
+        return read_memory_sync(self.cf, trajectory_mem_of(self.cf), entry.offset, len(sample)) == sample
+
+    def load(self, name):
+        """Make sure the trajectory is in trajectory memory, uploading it only if needed."""
+        entry = self.entries[name]
+        if entry.offset is None:
+            self._allocate(entry)
+        if entry.resident is None:
+            entry.resident = self._still_resident(entry)
+            print('Trajectory library: {} {} after reconnect'.format(
+                name, 'still resident' if entry.resident else 'lost'))
+        if not entry.resident:
+            write_image(self.cf, entry.data, entry.offset, label='Trajectory {}'.format(name))
+            entry.resident = True
+            self.uploads += 1
+        return entry
+
+    def preload(self, names=None):
+        """Load several entries, by default all of them, while on the ground."""
+        for name in names if names is not None else list(self.entries):
+            self.load(name)
+
+    def select(self, name):
+        """
+        Load the trajectory if needed and define it under its trajectory id.
+        Returns (trajectory_id, duration) for start_trajectory.
+        """
+        entry = self.load(name)
+        self.cf.high_level_commander.define_trajectory(
+            entry.trajectory_id, entry.offset, entry.n_pieces, type=entry.trajectory_type)
+        entry.last_used = next(self._clock)
+        self.switches += 1
+        return entry.trajectory_id, entry.duration
+
+    def report(self):
+        resident = sorted((entry.offset, entry.name, len(entry.data))
+                          for entry in self.entries.values() if entry.resident)
+        return 'Trajectory library: {} ({} bytes free), {} uploads for {} selections'.format(
+            ', '.join('{} @{} ({} B)'.format(name, offset, size) for offset, name, size in resident) or 'empty',
+            self.free_list.free_bytes(), self.uploads, self.switches)
+
+
+# link uri -> TrajectoryLibrary, kept across reconnects
+_libraries = {}
+
+
+def library_for(cf):
+    """The trajectory library of the drone cf is connected to."""
+    library = _libraries.get(cf.link_uri)
+    if library is None:
+        library = _libraries[cf.link_uri] = TrajectoryLibrary(cf)
+    else:
+        library.bind(cf)
+    return library
@@ -0,0 +1,112 @@
+"""
+Loader for uav_trajectories polynomial tables.
+
+See https://github.com/whoenig/uav_trajectories for the tool that generates
+them. Each row is one Poly4D segment with 33 columns:
+
+    Duration,x^0..x^7,y^0..y^7,z^0..z^7,yaw^0..yaw^7
+
+Both the CSV output of the tool (with its header line) and whitespace
+separated tables are accepted. Files are parsed with NumPy, so scientific
+notation such as 1.2986E-05 is read correctly, and the parsed array is cached
+as a .npy file keyed by the SHA-1 of the file contents. Later loads
+memory-map the cached copy instead of parsing the text again.
+"""
+import hashlib
+import os
+
+import numpy as np
+
+COLUMNS = 33
+
+TRAJECTORY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'trajectories')
+DEFAULT_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'trajectories')
+
+# (path, mtime_ns, size) -> array, so repeated loads in one process skip hashing
+_loaded = {}
+
+
+def _is_header(line):
+    try:
+        float(line.replace(',', ' ').split()[0])
+        return False
+    except (ValueError, IndexError):
+        return True
+
+
+def validate_trajectory(array, source='trajectory'):
+    """
+    Check that array is an (N, 33) table of finite values with positive
+    segment durations. Raises ValueError describing the first problem found.
+    """
+    if array.ndim != 2 or array.shape[1] != COLUMNS:
+        raise ValueError('{}: expected {} columns per segment, got shape {}'.format(
+            source, COLUMNS, array.shape))
+    if array.shape[0] == 0:
+        raise ValueError('{}: no segments'.format(source))
+    if not np.all(np.isfinite(array)):
+        row = int(np.argwhere(~np.isfinite(array))[0][0])
+        raise ValueError('{}: non-finite value in segment {}'.format(source, row))
+    if not np.all(array[:, 0] > 0):
+        row = int(np.argwhere(array[:, 0] <= 0)[0][0])
+        raise ValueError('{}: segment {} has non-positive duration {}'.format(
+            source, row, array[row, 0]))
+    return array
+
+
+def parse_trajectory_text(text, source='trajectory'):
+    """Parse a CSV or whitespace separated table into a validated (N, 33) array."""
+    lines = [line for line in text.splitlines() if line.strip()]
+    if lines and _is_header(lines[0]):
+        lines = lines[1:]
+    if not lines:
+        raise ValueError('{}: no segments'.format(source))
+
+    delimiter = ',' if ',' in lines[0] else None
+    try:
+        array = np.loadtxt(lines, delimiter=delimiter, dtype=np.float64, ndmin=2)
+    except ValueError as e:
+        raise ValueError('{}: {}'.format(source, e))
+
+    return validate_trajectory(array, source)
+
+
+def load_trajectory(path, cache_dir=DEFAULT_CACHE_DIR, mmap=True):
+    """
+    Load a trajectory file as an (N, 33) float64 array. With mmap the array
+    is a read-only memory map of the cached binary copy.
+    """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    if key in _loaded:
+        return _loaded[key]
+
+    with open(path, 'rb') as f:
+        raw = f.read()
+    digest = hashlib.sha1(raw).hexdigest()
+
+    cache_path = None
+    array = None
+    if cache_dir is not None:
+        cache_path = os.path.join(cache_dir, digest + '.npy')
+        if os.path.exists(cache_path):
+            array = np.load(cache_path, mmap_mode='r' if mmap else None)
+
+    if array is None:
+        array = parse_trajectory_text(raw.decode('utf-8'), source=path)
+        if cache_path is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            # Write under a temporary name so a crash never leaves a torn cache entry
+            temp_path = '{}.{}.tmp.npy'.format(cache_path[:-len('.npy')], os.getpid())
+            np.save(temp_path, array)
+            os.replace(temp_path, cache_path)
+            if mmap:
+                array = np.load(cache_path, mmap_mode='r')
+
+    _loaded[key] = array
+    return array
+
+
+def load_named_trajectory(file_name, cache_dir=DEFAULT_CACHE_DIR, mmap=True):
+    """Load one of the trajectories shipped in the trajectories/ directory."""
+    return load_trajectory(os.path.join(TRAJECTORY_DIR, file_name), cache_dir, mmap)
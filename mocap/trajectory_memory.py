@@ -0,0 +1,580 @@
+"""
+Trajectory memory uploads with content-hash skipping and delta writes.
+
+The scripts' upload_trajectory rebuilt the Poly4D list and rewrote the whole
+trajectory memory before every flight, even when nothing had changed. Here
+the host keeps a shadow copy of what each connected Crazyflie's trajectory
+memory holds, plus a hash per uploaded region. Uploading identical content
+is a no-op. When only some segments differ, only the byte ranges of those
+segments are written, through cflib's raw memory write.
+
+The shadow is dropped when the Crazyflie disconnects, since a reboot clears
+the memory.
+
+Written bytes are verified by reading back the first and last record of the
+write plus a few records picked at random and comparing CRC32s. The firmware
+has no checksum of its own for trajectory memory, so a mismatch is caught on
+the host and raised as an IOError before the trajectory can be defined and
+started.
+"""
+import hashlib
+import math
+import random
+import struct
+import time
+import zlib
+from threading import Condition
+from threading import Event
+from threading import Thread
+
+import numpy as np
+
+from cflib.crazyflie.high_level_commander import HighLevelCommander
+from cflib.crazyflie.mem import MemoryElement
+from cflib.crazyflie.mem import Poly4D
+
+from trajectory_analysis import DEFAULT_LIMITS
+from trajectory_analysis import check_feasible
+from trajectory_compression import encode_compressed
+from trajectory_compression import fidelity
+
+# One firmware poly4d record: x, y, z and yaw coefficients (4 x 8 floats) followed by the duration
+POLY4D_SIZE = 132
+
+
+# Memory image column order: the 32 coefficients, then the duration
+POLY4D_COLUMNS = list(range(1, 33)) + [0]
+
+
+def pack_trajectory(trajectory):
+    """
+    Serialize (N, 33) rows in uav_trajectories column order into the
+    firmware's poly4d memory layout, in one vectorized conversion.
+    """
+    return np.asarray(trajectory, dtype=np.float64)[:, POLY4D_COLUMNS].astype('<f4').tobytes()
+
+
+def trajectory_duration(trajectory):
+    return float(sum(row[0] for row in trajectory))
+
+
+def _wait_for_transfer(cf, mem, addr, start_transfer, done_callers, failed_callers, timeout):
+    done = Event()
+    result = {}
+
+    def _done(m, a, data=None):
+        if m.id == mem.id and a == addr:
+            result['ok'] = True
+            result['data'] = data
+            done.set()
+
+    # mem_read_failed_cb is called with (mem, addr, data), mem_write_failed_cb with (mem, addr)
+    def _failed(m, a, data=None):
+        if m.id == mem.id and a == addr:
+            result['ok'] = False
+            done.set()
+
+    for caller in done_callers:
+        caller.add_callback(_done)
+    for caller in failed_callers:
+        caller.add_callback(_failed)
+    try:
+        # cflib refuses a read while another read of the same memory is running, and no callback follows
+        if not start_transfer():
+            raise IOError('Memory transfer at 0x{:x} not started, another one of that memory is running'.format(addr))
+        if not done.wait(timeout):
+            raise TimeoutError('Memory transfer at 0x{:x} timed out'.format(addr))
+    finally:
+        for caller in done_callers:
+            caller.remove_callback(_done)
+        for caller in failed_callers:
+            caller.remove_callback(_failed)
+
+    if not result['ok']:
+        raise IOError('Memory transfer at 0x{:x} failed'.format(addr))
+    return result['data']
+
+
+def write_memory_sync(cf, mem, addr, data, timeout=10.0):
+    """Write raw bytes to a memory element and block until confirmed."""
+    _wait_for_transfer(cf, mem, addr, lambda: cf.mem.write(mem, addr, data),
+                       [cf.mem.mem_write_cb], [cf.mem.mem_write_failed_cb], timeout)
+
+
+def read_memory_sync(cf, mem, addr, length, timeout=10.0):
+    """Read raw bytes from a memory element, blocking until they arrive."""
+    return bytes(_wait_for_transfer(cf, mem, addr, lambda: cf.mem.read(mem, addr, length),
+                                    [cf.mem.mem_read_cb], [cf.mem.mem_read_failed_cb], timeout))
+
+
+class MemoryShadow:
+    """
+    Host-side copy of one Crazyflie's trajectory memory. `known` marks the
+    bytes whose drone-side content is known to equal `image`.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.image = bytearray(size)
+        self.known = bytearray(size)
+        # offset -> (length, sha1 hex digest) of uploaded regions
+        self.region_hashes = {}
+
+    def holds(self, offset, data, digest):
+        return self.region_hashes.get(offset) == (len(data), digest)
+
+    def changed_ranges(self, offset, data, granularity=POLY4D_SIZE):
+        """
+        Byte ranges, relative to data, that differ from the shadow. Compared
+        one record at a time, adjacent changed records are merged.
+        """
+        ranges = []
+        for start in range(0, len(data), granularity):
+            end = min(start + granularity, len(data))
+            absolute = slice(offset + start, offset + end)
+            if self.image[absolute] == data[start:end] and all(self.known[absolute]):
+                continue
+            if ranges and ranges[-1][1] == start:
+                ranges[-1] = (ranges[-1][0], end)
+            else:
+                ranges.append((start, end))
+        return ranges
+
+    def update(self, addr, data):
+        self.image[addr:addr + len(data)] = data
+        self.known[addr:addr + len(data)] = b'\x01' * len(data)
+
+    def forget(self, addr, length):
+        """Mark bytes as unknown, for example after a failed verification."""
+        self.known[addr:addr + length] = bytes(length)
+        for other, (region_length, _) in list(self.region_hashes.items()):
+            if other < addr + length and addr < other + region_length:
+                del self.region_hashes[other]
+
+    def set_region(self, offset, data, digest):
+        end = offset + len(data)
+        for other, (length, _) in list(self.region_hashes.items()):
+            if other < end and offset < other + length:
+                del self.region_hashes[other]
+        self.region_hashes[offset] = (len(data), digest)
+
+
+# (link uri, memory id) -> MemoryShadow
+_shadows = {}
+# ids of Crazyflie objects whose disconnects we already listen to
+_watched = set()
+
+
+def _forget_link(link_uri):
+    for key in [key for key in _shadows if key[0] == link_uri]:
+        del _shadows[key]
+
+
+def shadow_for(cf, mem):
+    """The memory shadow of a connected Crazyflie, created on first use."""
+    if id(cf) not in _watched:
+        cf.disconnected.add_callback(_forget_link)
+        _watched.add(id(cf))
+
+    key = (cf.link_uri, mem.id)
+    if key not in _shadows:
+        _shadows[key] = MemoryShadow(mem.size)
+    return _shadows[key]
+
+
+def trajectory_mem_of(cf):
+    return cf.mem.get_mems(MemoryElement.TYPE_TRAJ)[0]
+
+
+def _verification_blocks(ranges, samples, granularity=POLY4D_SIZE):
+    """
+    (begin, end) blocks to read back out of the written ranges: the first and
+    last block, plus samples blocks picked at random (all blocks if samples
+    is None).
+    """
+    blocks = [(start, min(start + granularity, end))
+              for begin, end in ranges for start in range(begin, end, granularity)]
+    if samples is None or len(blocks) <= samples + 2:
+        return blocks
+    middle = random.sample(blocks[1:-1], samples)
+    return [blocks[0]] + sorted(middle) + [blocks[-1]]
+
+
+def verify_image(cf, mem, data, offset, ranges, samples=2, label='Trajectory'):
+    """
+    Read back blocks of data written at offset and compare their CRC32 with
+    what was sent. Returns the list of (block offset, expected crc, read crc)
+    that do not match.
+    """
+    start = time.monotonic()
+    blocks = _verification_blocks(ranges, samples)
+    mismatches = []
+    for begin, end in blocks:
+        expected = zlib.crc32(data[begin:end])
+        actual = zlib.crc32(read_memory_sync(cf, mem, offset + begin, end - begin))
+        if actual != expected:
+            mismatches.append((offset + begin, expected, actual))
+
+    checked = sum(end - begin for begin, end in blocks)
+    print('{}: read back {} blocks ({} of {} bytes), {} in {:.1f} ms'.format(
+        label, len(blocks), checked, len(data),
+        'CRC32 mismatch at offsets {}'.format([m[0] for m in mismatches]) if mismatches else 'all CRC32s match',
+        (time.monotonic() - start) * 1000.0))
+    return mismatches
+
+
+def write_image(cf, data, offset=0, label='Trajectory', verify=True, verify_samples=2):
+    """
+    Make the trajectory memory hold data at offset, writing only what is not
+    already there. Returns the number of bytes written.
+
+    With verify the written bytes are checked with verify_image (the first,
+    last and verify_samples random records, or all of them if verify_samples
+    is None), and an IOError is raised on a mismatch.
+    """
+    mem = trajectory_mem_of(cf)
+    if offset < 0 or offset + len(data) > mem.size:
+        raise ValueError('{}: {} bytes at offset {} do not fit in {} bytes of trajectory memory'.format(
+            label, len(data), offset, mem.size))
+
+    start = time.monotonic()
+    shadow = shadow_for(cf, mem)
+    digest = hashlib.sha1(data).hexdigest()
+
+    written_ranges = []
+    if not shadow.holds(offset, data, digest):
+        written_ranges = shadow.changed_ranges(offset, data)
+        for begin, end in written_ranges:
+            write_memory_sync(cf, mem, offset + begin, data[begin:end])
+            shadow.update(offset + begin, data[begin:end])
+        shadow.set_region(offset, data, digest)
+    written = sum(end - begin for begin, end in written_ranges)
+
+    print('{}: {} of {} bytes written at offset {} in {:.1f} ms'.format(
+        label, written, len(data), offset, (time.monotonic() - start) * 1000.0))
+
+    if verify and written_ranges:
+        mismatches = verify_image(cf, mem, data, offset, written_ranges, verify_samples, label)
+        if mismatches:
+            for begin, end in written_ranges:
+                shadow.forget(offset + begin, end - begin)
+            raise IOError('{}: trajectory memory does not match the upload at offsets {}'.format(
+                label, [mismatch[0] for mismatch in mismatches]))
+    return written
+
+
+def encode_trajectory(trajectory, compressed=False, max_deviation=0.01, limits=DEFAULT_LIMITS,
+                      label='Trajectory', time_scale=1.0):
+    """
+    Check trajectory rows and encode them as a trajectory memory image.
+    Returns (data, n_pieces, trajectory_type) for define_trajectory.
+
+    The trajectory is checked against limits (a TrajectoryLimits, or None to
+    skip the check) at the time scale it will be flown at first, and refused
+    with a ValueError if it is infeasible.
+    With compressed the rows are encoded in the firmware's compressed format,
+    which is refused if the decoded trajectory strays more than max_deviation
+    metres from the original.
+    """
+    if limits is not None:
+        check_feasible(trajectory, limits, label, time_scale)
+
+    if not compressed:
+        return pack_trajectory(trajectory), len(trajectory), HighLevelCommander.TRAJECTORY_TYPE_POLY4D
+
+    data, n_pieces = encode_compressed(trajectory)
+    position_error, yaw_error = fidelity(trajectory, data, n_pieces)
+    print('{}: compressed to {} bytes from {} ({:.0f}%), max deviation {:.1f} mm, {:.2f} deg yaw'.format(
+        label, len(data), len(trajectory) * POLY4D_SIZE, 100.0 * len(data) / (len(trajectory) * POLY4D_SIZE),
+        position_error * 1000.0, math.degrees(yaw_error)))
+    if position_error > max_deviation:
+        raise ValueError('{}: compressed trajectory deviates {:.3f} m from the original'.format(
+            label, position_error))
+    return data, n_pieces, HighLevelCommander.TRAJECTORY_TYPE_POLY4D_COMPRESSED
+
+
+def upload_trajectory(cf, trajectory_id, trajectory, offset=0, compressed=False, max_deviation=0.01,
+                      limits=DEFAULT_LIMITS, time_scale=1.0):
+    """
+    Upload trajectory rows at offset in trajectory memory and define it as
+    trajectory_id. Returns the total duration, like the scripts' version.
+    See encode_trajectory for the checks and the compressed format.
+    """
+    label = 'Trajectory {}'.format(trajectory_id)
+    data, n_pieces, trajectory_type = encode_trajectory(trajectory, compressed, max_deviation, limits, label,
+                                                        time_scale)
+    write_image(cf, data, offset, label=label)
+    cf.high_level_commander.define_trajectory(trajectory_id, offset, n_pieces, type=trajectory_type)
+    return trajectory_duration(trajectory)
+
+
+class DoubleBufferedTrajectories:
+    """
+    Trajectory memory split into regions, each with its own trajectory id.
+    The trajectory being flown lives in one region while the next one is
+    uploaded into another region on a background thread, so switching
+    trajectories only costs a start_trajectory.
+
+        buffers = DoubleBufferedTrajectories(cf)
+        buffers.prepare(first)
+        buffers.start_next()
+        buffers.prepare(second)     # uploads while first is flying
+        ...
+        buffers.start_next()        # at the end of first
+    """
+
+    def __init__(self, cf, trajectory_ids=(1, 2)):
+        self.cf = cf
+        mem = trajectory_mem_of(cf)
+        # Regions start on record boundaries so delta uploads line up
+        self.region_size = (mem.size // len(trajectory_ids)) // POLY4D_SIZE * POLY4D_SIZE
+        self.slots = [(trajectory_id, index * self.region_size)
+                      for index, trajectory_id in enumerate(trajectory_ids)]
+
+        self._active = None
+        self._staged = None
+        self._thread = None
+        self._error = None
+
+    def _next_slot(self):
+        if self._active is None:
+            return 0
+        return (self._active + 1) % len(self.slots)
+
+    def _upload(self, slot, trajectory):
+        try:
+            trajectory_id, offset = self.slots[slot]
+            upload_trajectory(self.cf, trajectory_id, trajectory, offset)
+            self._staged = (slot, trajectory_duration(trajectory))
+        except Exception as e:
+            self._error = e
+
+    def prepare(self, trajectory, background=True):
+        """
+        Upload trajectory into the region after the active one and define
+        it, in the background unless background is False.
+        """
+        self.wait_ready()
+        if len(trajectory) * POLY4D_SIZE > self.region_size:
+            raise ValueError('Trajectory of {} segments does not fit in a {} byte region'.format(
+                len(trajectory), self.region_size))
+
+        self._staged = None
+        self._error = None
+        self._thread = Thread(target=self._upload, args=(self._next_slot(), trajectory), daemon=True)
+        self._thread.start()
+        if not background:
+            self.wait_ready()
+
+    def wait_ready(self, timeout=None):
+        """Wait for a background upload to finish, re-raising its error."""
+        if self._thread is not None:
+            self._thread.join(timeout)
+            if self._thread.is_alive():
+                raise TimeoutError('Trajectory upload still running')
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def start_next(self, time_scale=1.0, relative=True):
+        """Start the staged trajectory now. Returns its scaled duration."""
+        self.wait_ready()
+        if self._staged is None:
+            raise RuntimeError('No trajectory has been prepared')
+
+        slot, duration = self._staged
+        self.cf.high_level_commander.start_trajectory(self.slots[slot][0], time_scale, relative)
+        self._active = slot
+        self._staged = None
+        return duration * time_scale
+
+
+def fly_chained(cf, trajectories, time_scale=1.0, relative=True, buffers=None):
+    """
+    Fly trajectories back to back while airborne. Each one is uploaded while
+    the previous one flies and started at the previous one's end, measured
+    on a monotonic clock. Returns the total flight time.
+    """
+    if buffers is None:
+        buffers = DoubleBufferedTrajectories(cf)
+
+    buffers.prepare(trajectories[0], background=False)
+    start = time.monotonic()
+    deadline = start
+    for index in range(len(trajectories)):
+        remaining = deadline - time.monotonic()
+        if remaining > 0:
+            time.sleep(remaining)
+        deadline += buffers.start_next(time_scale, relative)
+        if index + 1 < len(trajectories):
+            buffers.prepare(trajectories[index + 1])
+
+    remaining = deadline - time.monotonic()
+    if remaining > 0:
+        time.sleep(remaining)
+    return time.monotonic() - start
+
+
+class TrajectoryRing:
+    """
+    Trajectory memory as a ring of equal slots for flying a table of any
+    length. The table is split into chunks of slot-sized runs of segments;
+    a background thread uploads each chunk into the next slot as soon as the
+    chunk that used to be there has finished flying, and every chunk is
+    defined and started at the moment the previous one ends. Chunks
+    alternate between trajectory ids so the next definition never replaces
+    the one being flown.
+
+        ring = TrajectoryRing(cf)
+        ring.fly(long_trajectory)   # blocks until the last chunk has flown
+
+    Like DoubleBufferedTrajectories it assumes it owns the trajectory memory.
+    """
+
+    def __init__(self, cf, slots=3, trajectory_ids=(1, 2)):
+        self.cf = cf
+        mem = trajectory_mem_of(cf)
+        self.chunk_segments = mem.size // slots // POLY4D_SIZE
+        if self.chunk_segments < 1:
+            raise ValueError('{} slots do not fit in {} bytes of trajectory memory'.format(slots, mem.size))
+        self.slots = slots
+        self.trajectory_ids = trajectory_ids
+
+        self._condition = Condition()
+        # Index of the chunk flying now, and of the last chunk in its slot
+        self._started = -1
+        self._uploaded = -1
+        self._error = None
+        self.stalls = []
+
+    def _offset(self, index):
+        return (index % self.slots) * self.chunk_segments * POLY4D_SIZE
+
+    def _upload_all(self, chunks):
+        try:
+            for index, chunk in enumerate(chunks):
+                with self._condition:
+                    # The slot is free once the chunk after its previous occupant has started
+                    self._condition.wait_for(lambda: self._started >= index - self.slots + 1 or
+                                             self._error is not None)
+                    if self._error is not None:
+                        return
+                write_image(self.cf, pack_trajectory(chunk), self._offset(index),
+                            label='Trajectory chunk {}/{}'.format(index + 1, len(chunks)))
+                with self._condition:
+                    self._uploaded = index
+                    self._condition.notify_all()
+        except Exception as e:
+            with self._condition:
+                self._error = e
+                self._condition.notify_all()
+
+    def _wait_uploaded(self, index):
+        with self._condition:
+            self._condition.wait_for(lambda: self._uploaded >= index or self._error is not None)
+            if self._error is not None:
+                raise self._error
+
+    def fly(self, trajectory, time_scale=1.0, relative=True, limits=DEFAULT_LIMITS):
+        """
+        Fly trajectory rows chunk by chunk. With relative every chunk is
+        started relative, which anchors it where the previous one ended, as
+        fly_chained does. The whole table is checked against limits at
+        time_scale before anything is uploaded. Returns the total flight time.
+        """
+        if limits is not None:
+            check_feasible(trajectory, limits, 'Streamed trajectory', time_scale)
+        chunks = [trajectory[start:start + self.chunk_segments]
+                  for start in range(0, len(trajectory), self.chunk_segments)]
+        print('Streaming {} segments as {} chunks of up to {} through {} slots'.format(
+            len(trajectory), len(chunks), self.chunk_segments, self.slots))
+
+        self._started = -1
+        self._uploaded = -1
+        self._error = None
+        self.stalls = []
+        uploader = Thread(target=self._upload_all, args=(chunks,), daemon=True)
+        uploader.start()
+
+        commander = self.cf.high_level_commander
+        start = None
+        deadline = None
+        try:
+            for index, chunk in enumerate(chunks):
+                self._wait_uploaded(index)
+                now = time.monotonic()
+                if deadline is not None:
+                    if now < deadline:
+                        time.sleep(deadline - now)
+                    else:
+                        # The upload did not keep up and the Crazyflie hovers at the chunk's end meanwhile
+                        self.stalls.append((index, now - deadline))
+                trajectory_id = self.trajectory_ids[index % len(self.trajectory_ids)]
+                commander.define_trajectory(trajectory_id, self._offset(index), len(chunk))
+                commander.start_trajectory(trajectory_id, time_scale, relative)
+                now = time.monotonic()
+                if start is None:
+                    start = deadline = now
+                deadline = max(deadline, now) + trajectory_duration(chunk) * time_scale
+                with self._condition:
+                    self._started = index
+                    self._condition.notify_all()
+
+            remaining = deadline - time.monotonic()
+            if remaining > 0:
+                time.sleep(remaining)
+        finally:
+            with self._condition:
+                if self._error is None and self._uploaded < len(chunks) - 1:
+                    self._error = RuntimeError('Streaming stopped')
+                self._condition.notify_all()
+            uploader.join()
+
+        if self.stalls:
+            print('Streaming stalled before {} chunks, {:.2f} s in total'.format(
+                len(self.stalls), sum(stall for _, stall in self.stalls)))
+        return time.monotonic() - start
+
+
+def _pack_poly4d_objects(trajectory):
+    """
+    The scripts' original path: a Poly4D object per row, serialized one
+    segment at a time the way cflib's TrajectoryMemory does.
+    """
+    segments = []
+    for row in trajectory:
+        segments.append(Poly4D(row[0], Poly4D.Poly(row[1:9]), Poly4D.Poly(row[9:17]),
+                               Poly4D.Poly(row[17:25]), Poly4D.Poly(row[25:33])))
+
+    data = bytearray()
+    for segment in segments:
+        data += struct.pack('<ffffffff', *segment.x.values)
+        data += struct.pack('<ffffffff', *segment.y.values)
+        data += struct.pack('<ffffffff', *segment.z.values)
+        data += struct.pack('<ffffffff', *segment.yaw.values)
+        data += struct.pack('<f', segment.duration)
+    return bytes(data)
+
+
+def benchmark_packing(sizes=(10, 30, 1000, 10000), repeats=20):
+    """Time the object path against pack_trajectory for tables of each size."""
+    rng = np.random.default_rng(0)
+    for size in sizes:
+        trajectory = rng.uniform(-1.0, 1.0, (size, 33))
+        trajectory[:, 0] = rng.uniform(0.5, 2.0, size)
+        rows = trajectory.tolist()
+        assert _pack_poly4d_objects(rows) == pack_trajectory(trajectory)
+
+        timings = []
+        for pack, table in ((_pack_poly4d_objects, rows), (pack_trajectory, trajectory)):
+            start = time.perf_counter()
+            for _ in range(repeats):
+                pack(table)
+            timings.append((time.perf_counter() - start) / repeats)
+        print('{:6d} segments: objects {:8.3f} ms, vectorized {:7.3f} ms, {:5.1f}x'.format(
+            size, timings[0] * 1000.0, timings[1] * 1000.0, timings[0] / timings[1]))
+
+
+if __name__ == '__main__':
+    benchmark_packing()
@@ -45,6 +45,8 @@ from cflib.crazyflie.syncCrazyflie import SyncCrazyflie
 from cflib.crazyflie.syncLogger import SyncLogger
 from cflib.utils import uri_helper
 
+from log_sink import log_sink_for
+
 # URI to the Crazyflie to connect to
 uri = uri_helper.uri_from_env(default='radio://0/80/2M/E7E7E7E7E7')
 
@@ -251,6 +253,7 @@ class LoggingExample:
 
         # Variable used to keep main loop occupied until disconnect
         self.is_connected = True
+        self._log_sink = None
 
     def _connected(self, link_uri):
         """ This callback is called form the Crazyflie API when a Crazyflie
@@ -268,6 +271,8 @@ class LoggingExample:
         # The fetch-as argument can be set to FP16 to save space in the log packet
         self._lg_stab.add_variable('pm.vbat', 'FP16')
 
+        self._log_sink = log_sink_for(self._lg_stab, print_every=10)
+
         # Adding the configuration cannot be done until a Crazyflie is
         # connected, since we need to check that the variables we
         # would like to log are in the TOC.
@@ -295,10 +300,7 @@ class LoggingExample:
 
     def _stab_log_data(self, timestamp, data, logconf):
         """Callback from a the log API when data arrives"""
-        print(f'[{timestamp}][{logconf.name}]: ', end='')
-        for name, value in data.items():
-            print(f'{name}: {value:3.3f} ', end='')
-        print()
+        self._log_sink.append(timestamp, data)
 
     def _connection_failed(self, link_uri, msg):
         """Callback when connection initial connection fails (i.e no Crazyflie
@@ -314,6 +316,8 @@ class LoggingExample:
     def _disconnected(self, link_uri):
         """Callback when the Crazyflie is disconnected (called in all cases)"""
         print('Disconnected from %s' % link_uri)
+        if self._log_sink is not None:
+            self._log_sink.close()
         self.is_connected = False
 
 
@@ -344,6 +348,7 @@ if __name__ == '__main__':
     with SyncCrazyflie(uri, cf=Crazyflie(rw_cache='./cache')) as scf:
         cf = scf.cf
         trajectory_id = 1
+        log_sink = log_sink_for(lg_stab, print_every=10)
         with SyncLogger(scf, lg_stab) as logger:
             #while True:
             for log_entry in logger:
@@ -361,7 +366,8 @@ if __name__ == '__main__':
                 data = log_entry[1]
                 logconf_name = log_entry[2]
 
-                print('[%d][%s]: %s' % (timestamp, logconf_name, data))
+                log_sink.append(timestamp, data)
+        log_sink.close()
             
 
     mocap_wrapper.close()
\ No newline at end of file
@@ -35,16 +35,24 @@ import os
 from threading import Thread
 
 import motioncapture
+import numpy as np
 
 import cflib.crtp
 from cflib.crazyflie import Crazyflie
 from cflib.crazyflie.log import LogConfig
-from cflib.crazyflie.mem import MemoryElement
-from cflib.crazyflie.mem import Poly4D
 from cflib.crazyflie.syncCrazyflie import SyncCrazyflie
 from cflib.crazyflie.syncLogger import SyncLogger
 from cflib.utils import uri_helper
 
+from bounded_logger import BoundedSyncLogger
+from estimator_convergence import ResetFastPath
+from flight_alignment import FlightAligner
+from flight_session import FlightSession
+from log_sink import log_sink_for
+from param_batch import apply_params
+from pose_scheduler import PoseScheduler
+from trajectory_library import library_for
+
 # URI to the Crazyflie to connect to
 uri = uri_helper.uri_from_env(default='radio://0/80/2M/E7E7E7E7E7')
 
@@ -71,6 +79,11 @@ send_full_pose = True
 # degrees. If this is a problem, increase orientation_std_dev a bit. The default value in the firmware is 4.5e-3.
 orientation_std_dev = 8.0e-3
 
+# Rate at which mocap poses are forwarded to the Crazyflie, and how frames
+# are resampled to it (PoseScheduler.HOLD or PoseScheduler.INTERPOLATE)
+extpose_rate_hz = 100
+extpose_resample_mode = PoseScheduler.HOLD
+
 # The trajectory to fly
 # See https://github.com/whoenig/uav_trajectories for a tool to generate
 # trajectories
@@ -213,47 +226,40 @@ def send_extpose_quat(cf, x, y, z, quat):
 
 
 def reset_estimator(cf):
-    cf.param.set_value('kalman.resetEstimation', '1')
-    time.sleep(0.1)
-    cf.param.set_value('kalman.resetEstimation', '0')
+    apply_params(cf, [('kalman.resetEstimation', '1'),
+                      ('kalman.resetEstimation', '0')], label='Estimator reset')
 
     # time.sleep(1)
     wait_for_position_estimator(cf)
 
 
-def adjust_orientation_sensitivity(cf):
-    cf.param.set_value('locSrv.extQuatStdDev', orientation_std_dev)
+def orientation_sensitivity_params():
+    return [('locSrv.extQuatStdDev', orientation_std_dev)]
 
 
-def activate_kalman_estimator(cf):
-    cf.param.set_value('stabilizer.estimator', '2')
+def kalman_estimator_params():
+    return [
+        ('stabilizer.estimator', '2'),
+        # Set the std deviation for the quaternion data pushed into the
+        # kalman filter. The default value seems to be a bit too low.
+        ('locSrv.extQuatStdDev', 0.06),
+    ]
 
-    # Set the std deviation for the quaternion data pushed into the
-    # kalman filter. The default value seems to be a bit too low.
-    cf.param.set_value('locSrv.extQuatStdDev', 0.06)
 
+def mellinger_controller_params():
+    return [('stabilizer.controller', '2')]
 
-def activate_mellinger_controller(cf):
-    cf.param.set_value('stabilizer.controller', '2')
 
+def adjust_orientation_sensitivity(cf):
+    apply_params(cf, orientation_sensitivity_params())
 
-def upload_trajectory(cf, trajectory_id, trajectory):
-    trajectory_mem = cf.mem.get_mems(MemoryElement.TYPE_TRAJ)[0]
-    trajectory_mem.trajectory = []
 
-    total_duration = 0
-    for row in trajectory:
-        duration = row[0]
-        x = Poly4D.Poly(row[1:9])
-        y = Poly4D.Poly(row[9:17])
-        z = Poly4D.Poly(row[17:25])
-        yaw = Poly4D.Poly(row[25:33])
-        trajectory_mem.trajectory.append(Poly4D(duration, x, y, z, yaw))
-        total_duration += duration
+def activate_kalman_estimator(cf):
+    apply_params(cf, kalman_estimator_params())
 
-    trajectory_mem.write_data_sync()
-    cf.high_level_commander.define_trajectory(trajectory_id, 0, len(trajectory_mem.trajectory))
-    return total_duration
+
+def activate_mellinger_controller(cf):
+    apply_params(cf, mellinger_controller_params())
 
 
 def run_sequence(cf, trajectory_id, duration):
@@ -294,6 +300,7 @@ class LoggingExample:
 
         # Variable used to keep main loop occupied until disconnect
         self.is_connected = True
+        self._log_sink = None
 
     def _connected(self, link_uri):
         """ This callback is called form the Crazyflie API when a Crazyflie
@@ -311,6 +318,8 @@ class LoggingExample:
         # The fetch-as argument can be set to FP16 to save space in the log packet
         self._lg_stab.add_variable('pm.vbat', 'FP16')
 
+        self._log_sink = log_sink_for(self._lg_stab, print_every=10)
+
         # Adding the configuration cannot be done until a Crazyflie is
         # connected, since we need to check that the variables we
         # would like to log are in the TOC.
@@ -338,10 +347,7 @@ class LoggingExample:
 
     def _stab_log_data(self, timestamp, data, logconf):
         """Callback from a the log API when data arrives"""
-        print(f'[{timestamp}][{logconf.name}]: ', end='')
-        for name, value in data.items():
-            print(f'{name}: {value:3.3f} ', end='')
-        print()
+        self._log_sink.append(timestamp, data)
 
     def _connection_failed(self, link_uri, msg):
         """Callback when connection initial connection fails (i.e no Crazyflie
@@ -357,6 +363,8 @@ class LoggingExample:
     def _disconnected(self, link_uri):
         """Callback when the Crazyflie is disconnected (called in all cases)"""
         print('Disconnected from %s' % link_uri)
+        if self._log_sink is not None:
+            self._log_sink.close()
         self.is_connected = False
 
 # if __name__ == '__main__':
@@ -422,34 +430,66 @@ if __name__ == '__main__':
     print("I am here.")
     with SyncCrazyflie(uri, cf=Crazyflie(rw_cache='./cache')) as scf:
         cf = scf.cf
-        trajectory_id = 1
-        with SyncLogger(scf, lg_stab) as logger:
+
+        # Send poses to the estimator at a fixed rate, whatever the frame timing
+        pose_scheduler = PoseScheduler(
+            lambda pose: send_extpose_quat(cf, pose[0], pose[1], pose[2], pose[3]),
+            rate_hz=extpose_rate_hz, mode=extpose_resample_mode)
+        # Set up a callback to handle data from the mocap system. Frames are
+        # recorded on the host clock to be aligned with the drone's log.
+        aligner = FlightAligner(rate_hz=100, forward_pose=pose_scheduler.on_pose)
+        mocap_wrapper.on_pose = aligner.on_pose
+
+        library = library_for(cf)
+        library.add('figure8', figure8)
+
+        # Parameters are written once per connection, figure8 is only uploaded
+        # when it is not resident and the estimator only reset when needed
+        session = FlightSession(cf, pose_scheduler,
+                                params=orientation_sensitivity_params() + kalman_estimator_params(),
+                                reset_estimator=ResetFastPath(reset_estimator), library=library)
+
+        log_sink = log_sink_for(lg_stab, print_every=10)
+        # Setup between sorties does not read the log, so its queue is
+        # bounded and the oldest samples are dropped instead of piling up
+        with BoundedSyncLogger(scf, lg_stab, maxsize=100) as logger:
+            def log_sortie(trajectory_id, duration):
+                print('The sequence is {:.1f} seconds long'.format(duration))
+                # run_sequence(cf, trajectory_id, duration)
+                endTime = time.time() + 10
+                aligner.reset()
+
+                for log_entry in logger:
+                    timestamp = log_entry[0]
+                    data = log_entry[1]
+
+                    log_sink.append(timestamp, data, logger.arrived)
+                    aligner.add_log_sample(timestamp, data, logger.arrived)
+
+                    if time.time() > endTime:
+                        break
+
+                # One table per flight of mocap and log on a common 100 Hz timeline
+                try:
+                    flight = aligner.merged()
+                except ValueError as e:
+                    print('Flight not aligned: {}'.format(e))
+                else:
+                    path = 'flight_logs/aligned_{}.npy'.format(time.strftime('%Y%m%d-%H%M%S'))
+                    np.save(path, flight)
+                    print('Aligned flight: {} rows, {}, saved to {}'.format(len(flight), aligner.clock, path))
+
             #while True:
             while True:
                 try:
-                    # Set up a callback to handle data from the mocap system
-                    mocap_wrapper.on_pose = lambda pose: send_extpose_quat(cf, pose[0], pose[1], pose[2], pose[3])
-                    time.sleep(3)
-                    adjust_orientation_sensitivity(cf)
-                    activate_kalman_estimator(cf)
                     # activate_mellinger_controller(cf)
-                    duration = upload_trajectory(cf, trajectory_id, figure8)
-                    print('The sequence is {:.1f} seconds long'.format(duration))
-                    reset_estimator(cf)
-                    # run_sequence(cf, trajectory_id, duration)
-                    endTime = time.time() + 10
-                    
-                    for log_entry in logger:
-                        timestamp = log_entry[0]
-                        data = log_entry[1]
-                        logconf_name = log_entry[2]
-
-                        print('[%d][%s]: %s' % (timestamp, logconf_name, data))
-
-                        if time.time() > endTime:
-                            break
+                    session.sortie(log_sortie, mission='figure8')
 
                 except(KeyboardInterrupt,SystemExit):
+                    print(session.report())
+                    print(logger.report())
+                    log_sink.close()
+                    pose_scheduler.close()
                     mocap_wrapper.close()
                     print("Socket error!")
                     sys.exit()       